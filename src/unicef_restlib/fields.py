@@ -1,31 +1,197 @@
+import hashlib
+import uuid
 from collections import OrderedDict
-
+from collections.abc import Mapping
+
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.db.models import ForeignObjectRel, ManyToManyField, ManyToOneRel, Model, Prefetch, QuerySet
+from django.db.models.signals import post_delete, post_save
+from django.utils import translation
 from django.utils.translation import gettext_lazy as _
 
 from model_utils import Choices
 from rest_framework import serializers
 from rest_framework.fields import empty, Field, SkipField
-from rest_framework.utils import model_meta
+from rest_framework.utils import html, model_meta
 from rest_framework_recursive.fields import RecursiveField
 
-from unicef_restlib.utils import get_attribute_smart
+from unicef_restlib.utils import compile_path, get_attribute_smart, get_values_lookup
 
 
 class builtin_field:
     pass
 
 
+# process local storage for cached choices, used if cache alias is not set
+_local_choices_cache = LocMemCache("unicef-restlib-choices", {})
+# cache aliases used for choices of model
+_choices_cache_aliases = {}
+
+
+def _get_choices_cache(alias):
+    return _local_choices_cache if alias is None else caches[alias]
+
+
+def _get_choices_version_key(model):
+    return "unicef_restlib:choices_version:{}".format(model._meta.concrete_model._meta.label_lower)
+
+
+def invalidate_model_choices(sender, **kwargs):
+    """Invalidate cached ModelChoiceField choices for model."""
+    model = sender._meta.concrete_model
+    for alias in _choices_cache_aliases.get(model, ()):
+        _get_choices_cache(alias).delete(_get_choices_version_key(model))
+
+
+def _register_choices_cache(model, alias):
+    model = model._meta.concrete_model
+    if model not in _choices_cache_aliases:
+        post_save.connect(invalidate_model_choices, dispatch_uid="unicef_restlib_invalidate_model_choices")
+        post_delete.connect(invalidate_model_choices, dispatch_uid="unicef_restlib_invalidate_model_choices")
+    _choices_cache_aliases.setdefault(model, set()).add(alias)
+
+
 class ModelChoiceField(serializers.PrimaryKeyRelatedField):
+    """Choices are built from queryset objects with `get_choice`.
+
+    If `cache_choices` is set, choices are shared between field instances
+    for `choices_cache_timeout` seconds, using `choices_cache_alias` cache
+    or process local memory. Cache is invalidated when objects of queryset
+    model are saved or deleted; changes without signals, e.g. `update()`,
+    are visible after timeout. Choices are cached per active language.
+    """
+
     default_error_messages = {
         "does_not_exist": _('Invalid option "{pk_value}" - option is not available.'),
     }
 
+    cache_choices = False
+    choices_cache_alias = None
+    choices_cache_timeout = 300
+    # resolve all values of the field from root serializer data with single
+    # query, e.g. for `many=True` or rows of list serializer
+    batch_lookup = True
+
     @property
     def choices(self):
         if hasattr(self._choices, "__call__"):
-            self._choices = self._choices()
+            if self.cache_choices:
+                self._choices = self._get_cached_choices()
+            else:
+                self._choices = self._choices()
         return self._choices
 
+    def _get_cached_choices(self):
+        queryset = self.get_queryset()
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return OrderedDict()
+
+        _register_choices_cache(queryset.model, self.choices_cache_alias)
+        cache = _get_choices_cache(self.choices_cache_alias)
+        # choices are stored under current version of model, so invalidation
+        # is just removal of version
+        version_key = _get_choices_version_key(queryset.model)
+        version = cache.get(version_key)
+        if version is None:
+            cache.add(version_key, uuid.uuid4().hex, None)
+            version = cache.get(version_key)
+
+        # labels of `get_choice` can be translated
+        key = "unicef_restlib:choices:{}".format(
+            hashlib.md5(
+                "{}:{}.{}:{}:{}:{}:{}".format(
+                    version,
+                    self.__class__.__module__,
+                    self.__class__.__qualname__,
+                    translation.get_language(),
+                    queryset.db,
+                    sql,
+                    params,
+                ).encode("utf-8")
+            ).hexdigest()
+        )
+        choices = cache.get(key)
+        if choices is None:
+            choices = self._choices()
+            cache.set(key, choices, self.choices_cache_timeout)
+        return choices
+
+    def _get_data_path(self):
+        """Return path to field values in root serializer data,
+        None stands for list of values.
+        """
+        path = []
+        field = self
+        while field.parent is not None:
+            # list serializer child and many related field child are bound without name
+            path.append(field.field_name or None)
+            field = field.parent
+        return path[::-1]
+
+    def _get_submitted_values(self, data):
+        values = [data]
+        path = self._get_data_path()
+        for i, step in enumerate(path):
+            next_values = []
+            for value in values:
+                if step is None:
+                    if isinstance(value, (list, tuple)):
+                        next_values.extend(value)
+                elif html.is_html_input(value) and i + 1 < len(path) and path[i + 1] is None:
+                    next_values.append(value.getlist(step))
+                elif isinstance(value, Mapping) and step in value:
+                    next_values.append(value[step])
+            values = next_values
+        return values
+
+    def _get_batch_key(self, model, value):
+        if isinstance(value, bool) or not isinstance(value, (str, int, uuid.UUID)):
+            return None
+        try:
+            if self.pk_field is not None:
+                value = self.pk_field.to_internal_value(value)
+            return model._meta.pk.to_python(value)
+        except (DjangoValidationError, serializers.ValidationError, TypeError, ValueError):
+            return None
+
+    def _get_batch(self):
+        """Return queryset model and objects for all values of the field in root
+        serializer data, None is stored for values which are not available in queryset.
+        """
+        initial_data = getattr(self.root, "initial_data", None)
+        if initial_data is None:
+            return None, None
+
+        batch = self.__dict__.get("_batch")
+        if batch is not None and batch[0] is initial_data:
+            return batch[1:]
+
+        queryset = self.get_queryset()
+        keys = {self._get_batch_key(queryset.model, value) for value in self._get_submitted_values(initial_data)}
+        keys.discard(None)
+
+        objects = dict.fromkeys(keys)
+        if keys:
+            objects.update((obj.pk, obj) for obj in queryset.filter(pk__in=keys))
+
+        self._batch = (initial_data, queryset.model, objects)
+        return queryset.model, objects
+
+    def to_internal_value(self, data):
+        model, objects = self._get_batch() if self.batch_lookup else (None, None)
+        if objects:
+            key = self._get_batch_key(model, data)
+            if key in objects:
+                if objects[key] is None:
+                    pk_value = self.pk_field.to_internal_value(data) if self.pk_field is not None else data
+                    self.fail("does_not_exist", pk_value=pk_value)
+                return objects[key]
+        return super().to_internal_value(data)
+
     def get_choice(self, obj):
         raise NotImplementedError
 
@@ -127,14 +293,169 @@ class WriteListSerializeFriendlyRecursiveField(RecursiveField):
         return self._proxied
 
 
+def _get_ordered_unique(values):
+    """Return unique values, model objects are ordered by primary key."""
+    seen = set()
+    unique = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            unique.append(value)
+
+    if all(isinstance(value, Model) and value.pk is not None for value in unique):
+        unique.sort(key=lambda value: value.pk)
+    return unique
+
+
+class ExportedValue(str):
+    """Representation of CommaSeparatedExportField prepared for many objects at once."""
+
+
+def _get_relation(opts, attr):
+    """Return relation field of model by attribute name, including reverse relations accessors."""
+    try:
+        field = opts.get_field(attr)
+    except FieldDoesNotExist:
+        field = None
+        for related_object in opts.related_objects:
+            if related_object.get_accessor_name() == attr:
+                field = related_object
+
+    if field is None or not field.is_relation or field.related_model is None:
+        return None
+    return field
+
+
 class CommaSeparatedExportField(serializers.Field):
+    """Export related objects, or their `export_attr`, as comma separated string.
+
+    Use `get_prefetch_lookups` to prefetch relations used by field,
+    see `unicef_restlib.views.ExportPrefetchMixin`.
+    """
+
     export_attr = None
 
     def __init__(self, *args, **kwargs):
         self.export_attr = kwargs.pop("export_attr", None)
         super().__init__(*args, **kwargs)
 
+    def get_prefetch_lookups(self, model):
+        """Return lookups to prefetch relations required by field for objects of `model`.
+        If export attribute is a field of related objects, only that field is loaded.
+        """
+        attrs = list(self.source_attrs)
+        if self.export_attr:
+            attrs.extend(self.export_attr.split("."))
+
+        relations = []
+        opts = model._meta
+        for attr in attrs:
+            relation = _get_relation(opts, attr)
+            if relation is None:
+                break
+            relations.append(relation)
+            opts = relation.related_model._meta
+
+        if not relations:
+            return []
+
+        depth = len(relations)
+        lookup = "__".join(attrs[:depth])
+        relation, rest = relations[-1], attrs[depth:]
+        if len(rest) != 1 or not relation.many_to_many and not isinstance(relation, ManyToOneRel):
+            return [lookup]
+
+        try:
+            export_field = opts.get_field(rest[0])
+        except FieldDoesNotExist:
+            return [lookup]
+        if not export_field.concrete or export_field.is_relation:
+            return [lookup]
+
+        only_fields = [opts.pk.name, export_field.name]
+        if isinstance(relation, ManyToOneRel):
+            # foreign key is required to join prefetched objects
+            only_fields.append(relation.field.name)
+        return [Prefetch(lookup, queryset=relation.related_model._default_manager.only(*only_fields))]
+
+    def get_batch_lookups(self, model):
+        """Return exported model, lookup from exported model to `model` and lookup of export attribute,
+        if field values for many objects of `model` can be loaded with single query.
+        It is possible if source is a path of to-many relations and export attribute
+        is a plain field of exported objects, otherwise None is returned.
+        """
+        if not self.source_attrs or not self.export_attr:
+            return None
+
+        reverse_lookups = []
+        opts = model._meta
+        for attr in self.source_attrs:
+            relation = _get_relation(opts, attr)
+            if not isinstance(relation, (ForeignObjectRel, ManyToManyField)):
+                return None
+            if not relation.one_to_many and not relation.many_to_many:
+                return None
+
+            if isinstance(relation, ForeignObjectRel):
+                reverse_lookups.append(relation.field.name)
+            else:
+                reverse_lookups.append(relation.related_query_name())
+            opts = relation.related_model._meta
+
+        export_lookup = get_values_lookup(opts.model, tuple(self.export_attr.split(".")))
+        if export_lookup is None:
+            return None
+
+        return opts.model, "__".join(reversed(reverse_lookups)), export_lookup
+
+    def get_batch_query(self, model, pks):
+        """Return queryset of (object pk, exported object pk, value) rows for objects
+        of `model` with `pks`, ordered as `to_representation` does, or None if not available.
+        """
+        lookups = self.get_batch_lookups(model)
+        if lookups is None:
+            return None
+
+        export_model, parent_lookup, export_lookup = lookups
+        # foreign key value may point to `to_field` instead of pk
+        parent_pk_lookup = "{}__pk".format(parent_lookup)
+        return (
+            export_model._default_manager.filter(**{"{}__in".format(parent_pk_lookup): pks})
+            .values_list(parent_pk_lookup, "pk", export_lookup)
+            .order_by(parent_pk_lookup, "pk")
+        )
+
+    def prepare_batch(self, instances):
+        """Build representation for all instances with single query,
+        so it is not calculated for each instance separately.
+        Returns False if field can't be prepared in batch.
+        """
+        model = getattr(getattr(self.parent, "Meta", None), "model", None)
+        values = {instance.pk: [] for instance in instances}
+        query = self.get_batch_query(model, list(values)) if model is not None else None
+        if query is None:
+            return False
+
+        seen = set()
+        for instance_pk, exported_pk, value in query:
+            # same object can be reached by different paths
+            if (instance_pk, exported_pk) in seen:
+                continue
+            seen.add((instance_pk, exported_pk))
+            if value:
+                values[instance_pk].append(str(value))
+
+        self._batch = {pk: ExportedValue(", ".join(items)) for pk, items in values.items()}
+        return True
+
+    def clear_batch(self):
+        self._batch = None
+
     def get_attribute(self, instance):
+        batch = self.__dict__.get("_batch")
+        if batch and getattr(instance, "pk", None) in batch:
+            return batch[instance.pk]
+
         try:
             return get_attribute_smart(instance, self.source_attrs)
         except (KeyError, AttributeError) as exc:
@@ -156,19 +477,45 @@ class CommaSeparatedExportField(serializers.Field):
             raise type(exc)(msg)
 
     def to_representation(self, value):
-        value = set(value)
+        if isinstance(value, ExportedValue):
+            return value
 
-        if self.export_attr:
-            value = [get_attribute_smart(item, self.export_attr) for item in value]
+        # unique objects ordered by primary key
+        if isinstance(value, QuerySet) and value._result_cache is None and not value.query.is_sliced:
+            value = value.order_by("pk")
+        else:
+            value = _get_ordered_unique(value)
 
+        # values are loaded lazily, so related objects are not kept in memory
+        value = compile_path(self.export_attr or "", lazy=True)(value)
         return ", ".join([str(item) for item in value if item])
 
 
 class DynamicChoicesField(serializers.ChoiceField):
+    """Choice field which choices can be changed after initialization.
+
+    Map of choices is built once, when choices are set, so choices should be
+    replaced instead of changed in place. For `Choices` its display map is used
+    and `Choices` object is shared between field copies.
+    """
+
     def __init__(self, *args, **kwargs):
         self._current_choices = {}
+        self._choice_strings_to_values = {}
         super().__init__(*args, **kwargs)
 
+    def __deepcopy__(self, memo):
+        # serializer fields are deep copied from declared ones for every serializer
+        # instance, Choices are not changed, so they can be shared with maps built
+        if self._args and isinstance(self._args[0], Choices):
+            # positional arguments are copied without memo
+            self._args, self._kwargs = self._args[1:], dict(self._kwargs, choices=self._args[0])
+
+        choices = self._kwargs.get("choices")
+        if isinstance(choices, Choices):
+            memo[id(choices)] = choices
+        return super().__deepcopy__(memo)
+
     @property
     def choices(self):
         return self._current_choices
@@ -176,12 +523,20 @@ class DynamicChoicesField(serializers.ChoiceField):
     @choices.setter
     def choices(self, value):
         self._current_choices = value
+        self._choice_strings_to_values = self._get_choice_strings_to_values(value)
+
+    @staticmethod
+    def _get_choice_strings_to_values(choices):
+        if isinstance(choices, Choices):
+            display_map = getattr(choices, "_display_map", None)
+            if display_map is not None:
+                return display_map
+            return {k: v for k, v in choices}
+        return {str(key): key for key in choices.keys()}
 
     @property
     def choice_strings_to_values(self):
-        if isinstance(self.choices, Choices):
-            return {k: v for k, v in self.choices}
-        return {str(key): key for key in self.choices.keys()}
+        return self._choice_strings_to_values
 
     @choice_strings_to_values.setter
     def choice_strings_to_values(self, value):
@@ -1,18 +1,282 @@
-from rest_framework.pagination import PageNumberPagination
+import datetime
+import functools
+import hashlib
+import json
+import operator
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet, ValidationError
+from django.core.paginator import Paginator as DjangoPaginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Model, Q, QuerySet
+from django.utils.functional import cached_property
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 
 class OptionalPaginationMixin:
-    def get_page_size(self, request):
+    def is_page_size_all(self, request):
         if self.page_size_query_param:
-            try:
-                if request.query_params[self.page_size_query_param] == "all":
-                    return None
-            except KeyError:
-                pass
+            return request.query_params.get(self.page_size_query_param) == "all"
+        return False
+
+    def get_page_size(self, request):
+        if self.is_page_size_all(request):
+            return None
         return super().get_page_size(request)
 
 
+class CountPaginator(DjangoPaginator):
+    """Django paginator with custom function to count objects."""
+
+    def __init__(self, object_list, per_page, count_function=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count_function = count_function
+
+    @cached_property
+    def count(self):
+        if self.count_function is None or not isinstance(self.object_list, QuerySet):
+            return super().count
+        return self.count_function(self.object_list)
+
+
 class DynamicPageNumberPagination(OptionalPaginationMixin, PageNumberPagination):
+    """Page number pagination with configurable count strategy:
+
+    * `exact` - `COUNT(*)` on every request;
+    * `cached` - exact count cached for `count_cache_timeout` seconds
+      in `count_cache_alias` cache, keyed on the counted query;
+    * `approximate` - planner row estimate is used if it is greater than
+      `approximate_count_threshold`, exact count otherwise.
+      Only PostgreSQL is supported, exact count is used for other databases.
+      Response contains `count_approximate` flag.
+    """
+
     page_size = 10
     page_size_query_param = "page_size"
     max_page_size = 1000
+
+    COUNT_EXACT = "exact"
+    COUNT_CACHED = "cached"
+    COUNT_APPROXIMATE = "approximate"
+
+    count_strategy = COUNT_EXACT
+    count_cache_alias = "default"
+    count_cache_timeout = 60
+    approximate_count_threshold = 10000
+
+    count_approximate = False
+
+    def django_paginator_class(self, object_list, per_page):
+        # DRF creates django paginator through this attribute.
+        self.count_approximate = False
+        count_function = None if self.count_strategy == self.COUNT_EXACT else self.get_count
+        return CountPaginator(object_list, per_page, count_function=count_function)
+
+    def get_count(self, queryset):
+        self.count_approximate = False
+
+        if self.count_strategy == self.COUNT_CACHED:
+            return self.get_cached_count(queryset)
+
+        if self.count_strategy == self.COUNT_APPROXIMATE:
+            estimate = self.get_estimated_count(queryset)
+            if estimate is not None and estimate > self.approximate_count_threshold:
+                self.count_approximate = True
+                return estimate
+
+        if not isinstance(queryset, QuerySet):
+            return len(queryset)
+        return queryset.count()
+
+    def get_cached_count(self, queryset):
+        if not isinstance(queryset, QuerySet):
+            return len(queryset)
+
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+
+        key = "unicef_restlib:count:{}".format(
+            hashlib.md5("{}:{}:{}".format(queryset.db, sql, params).encode("utf-8")).hexdigest()
+        )
+        count_cache = caches[self.count_cache_alias]
+        count = count_cache.get(key)
+        if count is None:
+            count = queryset.count()
+            count_cache.set(key, count, self.count_cache_timeout)
+        return count
+
+    def get_estimated_count(self, queryset):
+        """Return planner estimate of rows number or None if it is not available."""
+        if not isinstance(queryset, QuerySet):
+            return None
+
+        connection = connections[queryset.db]
+        if connection.vendor != "postgresql":
+            return None
+
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN (FORMAT JSON) {}".format(sql), params)
+            plan = cursor.fetchone()[0]
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.count_strategy == self.COUNT_APPROXIMATE:
+            response.data["count_approximate"] = self.count_approximate
+        return response
+
+
+class KeysetJSONEncoder(DjangoJSONEncoder):
+    """Encode datetime and time values with microseconds,
+    DjangoJSONEncoder truncates them to milliseconds, so rows between
+    keyset value and truncated one are skipped.
+    """
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+class KeysetPagination(OptionalPaginationMixin, CursorPagination):
+    """Keyset (seek) pagination.
+    Instead of OFFSET, page is selected by values of ordering fields
+    of the last seen object, so deep pages are as fast as the first one
+    and no COUNT query is required.
+
+    Ordering fields should be not nullable, primary key is added
+    to the end of ordering to make it stable.
+    """
+
+    page_size = 10
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+    ordering = ("-pk",)
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, "keyset_ordering", None) or self.ordering
+        if isinstance(ordering, str):
+            ordering = (ordering,)
+        ordering = list(ordering)
+        if not {"pk", "-pk", queryset.model._meta.pk.name, "-" + queryset.model._meta.pk.name} & set(ordering):
+            ordering.append("pk")
+        return ordering
+
+    def encode_keyset(self, values, reverse):
+        data = json.dumps({"v": values, "r": reverse}, cls=KeysetJSONEncoder).encode("utf-8")
+        return urlsafe_b64encode(data).decode("ascii")
+
+    def decode_keyset(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+
+        try:
+            data = json.loads(urlsafe_b64decode(encoded.encode("ascii")).decode("utf-8"))
+            values, reverse = data["v"], bool(data["r"])
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if not isinstance(values, list) or len(values) != len(self.ordering_fields):
+            raise NotFound(self.invalid_cursor_message)
+        return values, reverse
+
+    def get_keyset_filter(self, values, reverse):
+        """Build filter selecting objects after values in ordering,
+        e.g. `(a > 1) OR (a = 1 AND b > 2)`.
+        """
+        queries = []
+        for i, (field, descending) in enumerate(self.ordering_fields):
+            lookup = "lt" if descending != reverse else "gt"
+            equal = {ordering_field: value for (ordering_field, __), value in zip(self.ordering_fields[:i], values)}
+            queries.append(Q(**equal) & Q(**{"{}__{}".format(field, lookup): values[i]}))
+        return functools.reduce(operator.or_, queries)
+
+    def get_values(self, obj):
+        values = []
+        for field, __ in self.ordering_fields:
+            value = functools.reduce(getattr, field.split("__"), obj)
+            if isinstance(value, Model):
+                value = value.pk
+            values.append(value)
+        return json.loads(json.dumps(values, cls=KeysetJSONEncoder))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        ordering = self.get_ordering(request, queryset, view)
+        self.ordering_fields = [(field.lstrip("-"), field.startswith("-")) for field in ordering]
+
+        values, reverse = self.decode_keyset(request)
+
+        if reverse:
+            queryset = queryset.order_by(*[field[1:] if field.startswith("-") else "-" + field for field in ordering])
+        else:
+            queryset = queryset.order_by(*ordering)
+        if values is not None:
+            try:
+                queryset = queryset.filter(self.get_keyset_filter(values, reverse))
+            except (ValueError, TypeError, ValidationError):
+                # cursor values don't match ordering fields types
+                raise NotFound(self.invalid_cursor_message)
+
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, values is not None
+
+        self.page = results
+        return results
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, self.encode_keyset(self.get_values(self.page[-1]), False)
+        )
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, self.encode_keyset(self.get_values(self.page[0]), True)
+        )
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data),
+                ]
+            )
+        )
@@ -21,3 +21,6 @@ class NestedComplexRouter(routers.NestedSimpleRouter):
         viewset.parent = parent_viewset
         viewset.parent_lookup_field = self.nest_prefix[:-1]
         viewset.parent_lookup_kwarg = self.nest_prefix + getattr(parent_viewset, "lookup_field", "pk")
+        if hasattr(viewset, "_clear_parents_cache"):
+            # parents chain changed, filter templates should be rebuilt on first use
+            viewset._clear_parents_cache()
@@ -0,0 +1,94 @@
+import functools
+import operator
+
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+
+TEXT_LOOKUPS = {"exact", "iexact", "contains", "icontains", "startswith", "istartswith", "search", "trigram_similar"}
+
+
+def get_search_field(search_term):
+    """Strip text lookup from search term, so `name__icontains` becomes `name`."""
+    field, __, lookup = search_term.rpartition("__")
+    if field and lookup in TEXT_LOOKUPS:
+        return field
+    return search_term
+
+
+class LookupSearchBackend:
+    """Default search backend.
+    Combine lookups from `search_terms` with OR, e.g. `name__icontains`.
+    """
+
+    def get_query(self, search_terms, search_value):
+        return functools.reduce(operator.or_, [Q(**{term: search_value}) for term in search_terms], Q())
+
+    def filter_queryset(self, queryset, search_terms, search_value):
+        return queryset
+
+
+class FullTextSearchBackend(LookupSearchBackend):
+    """PostgreSQL full text search backend.
+    Fields from `search_terms` are combined into `SearchVector`,
+    results are ordered by rank.
+
+    To use index create GIN index with the same `SearchVector` expression
+    and `config`.
+    """
+
+    config = None
+    search_type = "websearch"
+    vector_annotation = "search_vector"
+    rank_annotation = "search_rank"
+
+    def get_query(self, search_terms, search_value):
+        return Q()
+
+    def filter_queryset(self, queryset, search_terms, search_value):
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+
+        if not search_terms:
+            return queryset
+
+        vector = SearchVector(*[get_search_field(term) for term in search_terms], config=self.config)
+        query = SearchQuery(search_value, config=self.config, search_type=self.search_type)
+
+        queryset = queryset.annotate(
+            **{self.vector_annotation: vector, self.rank_annotation: SearchRank(vector, query)}
+        )
+        queryset = queryset.filter(**{self.vector_annotation: query})
+        return queryset.order_by(F(self.rank_annotation).desc(), *queryset.query.order_by)
+
+
+class TrigramSearchBackend(LookupSearchBackend):
+    """PostgreSQL trigram similarity search backend.
+    Requires `pg_trgm` extension, see `TrigramExtension` migration operation,
+    and `django.contrib.postgres` in `INSTALLED_APPS`.
+    Objects similar by any of `search_terms` fields are returned ordered
+    by the best similarity. Similarity threshold is controlled by
+    `pg_trgm.similarity_threshold` setting.
+
+    To use index create GIN or GiST index with `gin_trgm_ops`
+    or `gist_trgm_ops` operator class on search fields.
+    """
+
+    similarity_annotation = "search_similarity"
+
+    def get_query(self, search_terms, search_value):
+        return functools.reduce(
+            operator.or_,
+            [Q(**{"{}__trigram_similar".format(get_search_field(term)): search_value}) for term in search_terms],
+            Q(),
+        )
+
+    def filter_queryset(self, queryset, search_terms, search_value):
+        from django.contrib.postgres.search import TrigramSimilarity
+
+        if not search_terms:
+            return queryset
+
+        similarities = [TrigramSimilarity(get_search_field(term), search_value) for term in search_terms]
+        similarity = similarities[0] if len(similarities) == 1 else Greatest(*similarities)
+
+        queryset = queryset.annotate(**{self.similarity_annotation: similarity})
+        return queryset.order_by(F(self.similarity_annotation).desc(), *queryset.query.order_by)
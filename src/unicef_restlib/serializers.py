@@ -1,9 +1,10 @@
-from collections import OrderedDict
+from collections import defaultdict, namedtuple, OrderedDict
 
+from django.apps import apps
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models, transaction
+from django.db import connections, models, router, transaction
 from django.db.models.fields import related, related_descriptors
 from django.utils.decorators import method_decorator
 from django.utils.translation import gettext_lazy as _
@@ -15,41 +16,69 @@ from rest_framework.utils import model_meta
 from rest_framework.validators import BaseUniqueForValidator, UniqueTogetherValidator, UniqueValidator
 from unicef_djangolib.fields import CodedGenericRelation
 
+from unicef_restlib.fields import CommaSeparatedExportField
 from unicef_restlib.utils import pop_keys
 
 
+def warm_up_content_types(*model_classes):
+    """Load content types into ContentType manager cache with single query,
+    so first nested save of generic relations after deploy doesn't need
+    to fetch them. Can be called on startup, e.g. in wsgi.py.
+
+    By default content types are loaded for all models with generic relations.
+    """
+    if not model_classes:
+        model_classes = [
+            model
+            for model in apps.get_models()
+            if any(isinstance(field, GenericRelation) for field in model._meta.private_fields)
+        ]
+
+    return ContentType.objects.get_for_models(*model_classes)
+
+
 class PKSerializerMixin:
     _pk_field = None
+    # Model primary key name resolved per serializer class.
+    _model_pk_name = None
 
-    @property
-    def pk_field(self):
-        if self._pk_field:
-            return self._pk_field
+    @classmethod
+    def _get_model_pk_name(cls):
+        if "_model_pk_name" in cls.__dict__:
+            return cls._model_pk_name
 
-        assert hasattr(self, "Meta"), 'Class {serializer_class} missing "Meta" attribute'.format(
-            serializer_class=self.__class__.__name__
+        assert hasattr(cls, "Meta"), 'Class {serializer_class} missing "Meta" attribute'.format(
+            serializer_class=cls.__name__
         )
-        assert hasattr(self.Meta, "model"), 'Class {serializer_class} missing "Meta.model" attribute'.format(
-            serializer_class=self.__class__.__name__
+        assert hasattr(cls.Meta, "model"), 'Class {serializer_class} missing "Meta.model" attribute'.format(
+            serializer_class=cls.__name__
         )
-        if model_meta.is_abstract_model(self.Meta.model):
+        if model_meta.is_abstract_model(cls.Meta.model):
             raise ValueError("Cannot use ModelSerializer with Abstract Models.")
 
-        model = self.Meta.model
-        info = model_meta.get_field_info(model)
+        info = model_meta.get_field_info(cls.Meta.model)
+        cls._model_pk_name = info.pk.name
+        return cls._model_pk_name
+
+    @property
+    def pk_field(self):
+        if self._pk_field:
+            return self._pk_field
+
+        pk_name = self._get_model_pk_name()
 
         if "pk" in self.fields:
             self._pk_field = self.fields["pk"]
             return self._pk_field
 
-        if info.pk.name in self.fields:
-            self._pk_field = self.fields[info.pk.name]
+        if pk_name in self.fields:
+            self._pk_field = self.fields[pk_name]
             return self._pk_field
 
         assert False, (
             "Serializer {serializer_class} doesn't contain primary key field. "
             "Add `pk` or `{pk_name}` to fields attribute.".format(
-                serializer_class=self.__class__.__name__, pk_name=info.pk.name
+                serializer_class=self.__class__.__name__, pk_name=pk_name
             )
         )
 
@@ -106,30 +135,247 @@ class DeletableSerializerMixin(metaclass=SerializerMetaclass):
 class WritableListSerializer(serializers.ListSerializer):
     """List serializer that allow modify nested objects including
     creation and deleting.
+
+    Set `Meta.bulk_write = True` on child serializer to save objects
+    with `bulk_create` and `bulk_update` instead of calling
+    `child.create` and `child.update` for every object.
+    Bulk saving skips model `save` method and signals, so it is suitable
+    only for children without nested writable serializers and custom
+    create/update logic.
+
+    Set `Meta.load_payload_only = True` on child serializer to load only
+    objects which pks are sent instead of all related objects.
+    Objects already prefetched with `prefetch_related` are reused.
+    In this mode objects omitted in non-partial update are deleted
+    with single query without loading them.
+
+    Deleting of omitted objects can be tuned on child serializer:
+    `Meta.delete_chunk_size` deletes objects by chunks of given size,
+    so signals are sent without loading all objects at once;
+    `Meta.raw_delete = True` always uses single `DELETE` statement,
+    skipping signals and cascades.
     """
 
-    @method_decorator(transaction.atomic)
-    def update(self, instance, validated_data):
+    @property
+    def bulk_write(self):
+        return getattr(self.child.Meta, "bulk_write", False)
+
+    @property
+    def load_payload_only(self):
+        return getattr(self.child.Meta, "load_payload_only", False)
+
+    def _get_exists_instances(self, instance, validated_data):
+        """Return exists objects which can be modified.
+        :param instance: related manager, queryset or list of objects.
+        :param validated_data: list of objects data.
+        :return: Tuple contained dictionary of loaded objects by pk
+        and queryset to find omitted objects if they were not loaded.
+        """
         if isinstance(instance, models.Manager):
             instance = instance.all()
-        exists_instances = {i.pk: i for i in instance}
+
+        # Related manager returns evaluated queryset if parent was
+        # loaded with prefetch_related, so there is no need in extra queries.
+        if (
+            not self.load_payload_only
+            or not isinstance(instance, models.QuerySet)
+            or instance._result_cache is not None
+        ):
+            return {i.pk: i for i in instance}, None
+
+        pks = {pk for pk in map(self._get_pk, validated_data) if pk}
+        exists_instances = {i.pk: i for i in instance.filter(pk__in=pks)} if pks else {}
+
+        return exists_instances, instance
+
+    def _delete_instances(self, queryset):
+        """Delete objects from queryset according to child serializer options."""
+        meta = self.child.Meta
+
+        if getattr(meta, "raw_delete", False):
+            queryset._raw_delete(queryset.db)
+            return
+
+        chunk_size = getattr(meta, "delete_chunk_size", None)
+        if not chunk_size:
+            queryset.delete()
+            return
+
+        pks = list(queryset.values_list("pk", flat=True))
+        for start in range(0, len(pks), chunk_size):
+            end = start + chunk_size
+            queryset.model._default_manager.filter(pk__in=pks[start:end]).delete()
+
+    def _bulk_prepare(self, instance, data):
+        """Validate data and apply it to instance without saving.
+        :param instance: exists instance or None for new one.
+        :param data: validated data of object.
+        :return: Tuple contained instance, many to many data and
+        flag if instance should be deleted.
+        """
+        child = self.child
+        model = child.Meta.model
+
+        delete_field = getattr(child, "_delete_field", None)
+        if delete_field and data.pop(delete_field.source, False):
+            if instance is None:
+                raise serializers.ValidationError({child.Meta.delete_field: [_("You can't delete not exist object.")]})
+            return instance, {}, True
+
+        if instance is None and hasattr(child, "_run_required_validation"):
+            child._run_required_validation(data)
+        if hasattr(child, "_run_deferred_validators"):
+            child._run_deferred_validators(instance, data)
+
+        info = model_meta.get_field_info(model)
+        many_to_many = {}
+        for attr in list(data.keys()):
+            if attr in info.relations and info.relations[attr].to_many:
+                many_to_many[attr] = data.pop(attr)
+
+        if instance is None:
+            instance = model(**data)
+        else:
+            for attr, value in data.items():
+                setattr(instance, attr, value)
+
+        return instance, many_to_many, False
+
+    def _bulk_save(self, created, updated, deleted, update_fields):
+        """Save prepared instances using bulk queries.
+        :param created: list of tuples with new instance and many to many data.
+        :param updated: list of tuples with exists instance and many to many data.
+        :param deleted: list of instances to delete.
+        :param update_fields: fields which were sent for exists instances.
+        """
+        model = self.child.Meta.model
+        update_fields = update_fields - {"pk", model._meta.pk.name, model._meta.pk.attname}
+
+        # unique values freed by deleted and updated objects can be taken by next ones
+        if deleted:
+            model._default_manager.filter(pk__in=[instance.pk for instance in deleted]).delete()
+        if updated and update_fields:
+            model._default_manager.bulk_update([instance for instance, __ in updated], sorted(update_fields))
+        if created:
+            if connections[router.db_for_write(model)].features.can_return_rows_from_bulk_insert:
+                model._default_manager.bulk_create([instance for instance, __ in created])
+            else:
+                # bulk_create doesn't set pks on this database, but they are required
+                # for many to many data and returned objects, so save one by one
+                for instance, __ in created:
+                    instance.save(force_insert=True)
+
+        for instance, many_to_many in created + updated:
+            for attr, value in many_to_many.items():
+                getattr(instance, attr).set(value)
+
+    def _get_pk(self, data):
+        # PK used to detect exists objects.
+        try:
+            return get_attribute(data, self.child.pk_field.source_attrs)
+        except KeyError:
+            return None
+
+    def _get_batched_unique_validators(self):
+        """Return deferred unique validators of child that can be checked
+        for the whole list with single query.
+        :return: List of tuples contained field and validator.
+        """
+        validators = []
+        for field in self.child.fields.values():
+            for validator in getattr(field, "_deferred_validators", []):
+                if isinstance(validator, UniqueValidator) and validator.lookup == "exact":
+                    validators.append((field, validator))
+        return validators
+
+    def _run_batched_unique_validators(self, validators, validated_data):
+        """Check unique validators for all objects using one `__in` query
+        per validator. Duplicates inside of data are detected too.
+        :param validators: validators from `_get_batched_unique_validators`.
+        :param validated_data: list of objects data.
+        :return: Dictionary with errors by object position.
+        """
+        delete_field = getattr(self.child, "_delete_field", None)
+
+        errors = {}
+        for field, validator in validators:
+            field_name = field.source_attrs[-1]
+
+            # Objects saved earlier free their current value for the next objects.
+            released = {}
+            values = []
+            for position, data in enumerate(validated_data):
+                pk = self._get_pk(data)
+                if delete_field and data.get(delete_field.source, False):
+                    if pk:
+                        released.setdefault(pk, position)
+                    continue
+
+                if pk and field.field_name in data:
+                    released.setdefault(pk, position)
+
+                value = data.get(field.field_name)
+                if not value:
+                    continue
+
+                if isinstance(value, models.Model):
+                    value = value.pk
+                values.append((position, pk, value))
+
+            if not values:
+                continue
+
+            exists_pks = defaultdict(set)
+            queryset = validator.queryset.filter(**{"{}__in".format(field_name): {value for __, __, value in values}})
+            for value, pk in queryset.values_list(field_name, "pk"):
+                exists_pks[value].add(pk)
+
+            seen = set()
+            for position, pk, value in values:
+                conflicts = {
+                    exists_pk for exists_pk in exists_pks[value] if released.get(exists_pk, position) >= position
+                }
+                if conflicts - {pk} or value in seen:
+                    errors.setdefault(position, {})[field.field_name] = serializers.ValidationError(
+                        validator.message, code="unique"
+                    ).detail
+                seen.add(value)
+
+        return errors
+
+    @method_decorator(transaction.atomic)
+    def update(self, instance, validated_data):
+        batched_validators = self._get_batched_unique_validators()
+        self.child._batched_validators = [validator for __, validator in batched_validators]
+        try:
+            return self._update(
+                instance, validated_data, self._run_batched_unique_validators(batched_validators, validated_data)
+            )
+        finally:
+            self.child._batched_validators = []
+
+    def _update(self, instance, validated_data, unique_errors):
+        exists_instances, omitted_queryset = self._get_exists_instances(instance, validated_data)
         excess_instances_pks = set(exists_instances.keys())
 
         model = self.child.Meta.model
+        bulk_write = self.bulk_write
+
+        created, updated, deleted = [], [], []
+        update_fields = set()
 
         result = list()
         errors = list()
         has_error = False
-        for data in validated_data:
+        for position, data in enumerate(validated_data):
             errors.append(dict())
 
-            # PK used to detect exists objects.
-            try:
-                pk = get_attribute(data, self.child.pk_field.source_attrs)
-            except KeyError:
-                pk = None
+            pk = self._get_pk(data)
 
             try:
+                if position in unique_errors:
+                    raise serializers.ValidationError(unique_errors[position])
+
                 if pk:
                     if pk not in exists_instances:
                         raise serializers.ValidationError(
@@ -150,7 +396,21 @@ class WritableListSerializer(serializers.ListSerializer):
                         )
                     excess_instances_pks.remove(pk)
 
-                    result.append(self.child.update(exists_instances[pk], data))
+                    if bulk_write:
+                        nested_instance, many_to_many, delete = self._bulk_prepare(exists_instances[pk], data)
+                        if delete:
+                            deleted.append(nested_instance)
+                            nested_instance = None
+                        else:
+                            updated.append((nested_instance, many_to_many))
+                            update_fields.update(data.keys())
+                        result.append(nested_instance)
+                    else:
+                        result.append(self.child.update(exists_instances[pk], data))
+                elif bulk_write:
+                    nested_instance, many_to_many, __ = self._bulk_prepare(None, data)
+                    created.append((nested_instance, many_to_many))
+                    result.append(nested_instance)
                 else:
                     result.append(self.child.create(data))
 
@@ -161,8 +421,16 @@ class WritableListSerializer(serializers.ListSerializer):
         if has_error:
             raise serializers.ValidationError(errors)
 
-        if excess_instances_pks and not getattr(self.root, "partial", False):
-            model._default_manager.filter(pk__in=excess_instances_pks).delete()
+        if bulk_write:
+            self._bulk_save(created, updated, deleted, update_fields)
+
+        if getattr(self.root, "partial", False):
+            return result
+
+        if omitted_queryset is not None:
+            self._delete_instances(omitted_queryset.exclude(pk__in=[obj.pk for obj in result if obj is not None]))
+        elif excess_instances_pks:
+            self._delete_instances(model._default_manager.filter(pk__in=excess_instances_pks))
 
         return result
 
@@ -172,6 +440,9 @@ class WritableNestedChildSerializerMixin(PKSerializerMixin):
     related data as nested serializer.
     """
 
+    # Unique validators already checked by list serializer for all objects.
+    _batched_validators = []
+
     class Meta:
         list_serializer_class = WritableListSerializer
 
@@ -225,6 +496,9 @@ class WritableNestedChildSerializerMixin(PKSerializerMixin):
                 continue
 
             for validator in field._deferred_validators:
+                if any(validator is batched for batched in self._batched_validators):
+                    continue
+
                 if hasattr(validator, "set_context"):
                     validator.set_context(field)
 
@@ -241,25 +515,28 @@ class WritableNestedChildSerializerMixin(PKSerializerMixin):
         if errors:
             raise serializers.ValidationError(errors)
 
-    def create(self, validation_data):
+    def _run_required_validation(self, validation_data):
         # We can create child instance through partial update of
         # parent instance.
         # In this case validation allow to skip required fields
         # and we create instance without these fields.
         # To avoid this we make additional validation for required fields.
-        if getattr(self.root, "partial", False):
-            fields = self._writable_fields
-            errors = dict()
-            for field in fields:
-                if field.required and field.field_name not in validation_data:
-                    try:
-                        field.fail("required")
-                    except serializers.ValidationError as exc:
-                        errors[field.field_name] = exc.detail
-
-            if errors:
-                raise serializers.ValidationError(errors)
+        if not getattr(self.root, "partial", False):
+            return
 
+        errors = dict()
+        for field in self._writable_fields:
+            if field.required and field.field_name not in validation_data:
+                try:
+                    field.fail("required")
+                except serializers.ValidationError as exc:
+                    errors[field.field_name] = exc.detail
+
+        if errors:
+            raise serializers.ValidationError(errors)
+
+    def create(self, validation_data):
+        self._run_required_validation(validation_data)
         self._run_deferred_validators(None, validation_data)
 
         return super().create(validation_data)
@@ -269,6 +546,12 @@ class WritableNestedChildSerializerMixin(PKSerializerMixin):
         return super().update(instance, validation_data)
 
 
+RelationPlan = namedtuple(
+    "RelationPlan",
+    ["model_field", "relation_type", "related_fields", "content_type_field_name", "for_concrete_model", "extra_data"],
+)
+
+
 class WritableNestedParentSerializerMixin:
     """Serializer that allow to create and update nested objects."""
 
@@ -280,31 +563,78 @@ class WritableNestedParentSerializerMixin:
             if isinstance(field, serializers.BaseSerializer) and not field.read_only
         ]
 
-    def _get_related_model_field(self, nested_serializer):
-        """Return model field through that nested serializer relate with
-        parent and type of relation.
+    # Relation plans resolved per serializer class, see `_get_relation_plan`.
+    _relation_plans = None
+
+    def _resolve_relation_plan(self, nested_serializer):
+        """Walk model descriptor and build relation plan for nested serializer.
         :param nested_serializer:
-        :return: Tuple contained model field and relation type
-        (`forward`, `reverse`).
+        :return: RelationPlan instance.
         """
         assert len(nested_serializer.source_attrs) == 1, "We don't support fields with complex source."
 
         related_descriptor = get_attribute(self.Meta.model, nested_serializer.source_attrs)
 
         if isinstance(related_descriptor, related_descriptors.ReverseOneToOneDescriptor):
-            return related_descriptor.related.field, "forward"
-        if isinstance(related_descriptor, related_descriptors.ReverseManyToOneDescriptor):
-            return related_descriptor.field, "forward"
-        if isinstance(related_descriptor, related_descriptors.ForwardManyToOneDescriptor) and isinstance(
+            related_model_field, relation_type = related_descriptor.related.field, "forward"
+        elif isinstance(related_descriptor, related_descriptors.ReverseManyToOneDescriptor):
+            related_model_field, relation_type = related_descriptor.field, "forward"
+        elif isinstance(related_descriptor, related_descriptors.ForwardManyToOneDescriptor) and isinstance(
             related_descriptor.field, related.OneToOneField
         ):
-            return related_descriptor.field, "reverse"
+            related_model_field, relation_type = related_descriptor.field, "reverse"
+        else:
+            assert False, (
+                "We don't support many to many relation and forward many to one "
+                "because updating this relation have side effect."
+            )
 
-        assert False, (
-            "We don't support many to many relation and forward many to one "
-            "because updating this relation have side effect."
+        related_fields = tuple(
+            (lr_field.attname, fr_field.attname) for lr_field, fr_field in related_model_field.related_fields
         )
 
+        content_type_field_name, for_concrete_model = None, True
+        if isinstance(related_model_field, GenericRelation):
+            content_type_field_name = related_model_field.content_type_field_name
+            for_concrete_model = related_model_field.for_concrete_model
+
+        extra_data = {}
+        if isinstance(related_model_field, CodedGenericRelation):
+            extra_data[related_model_field.code_field] = related_model_field.code
+
+        return RelationPlan(
+            related_model_field,
+            relation_type,
+            related_fields,
+            content_type_field_name,
+            for_concrete_model,
+            extra_data,
+        )
+
+    def _get_relation_plan(self, nested_serializer):
+        """Return relation plan for nested serializer.
+        Plan is resolved once per serializer class and field.
+        """
+        cls = self.__class__
+        if "_relation_plans" not in cls.__dict__:
+            cls._relation_plans = {}
+
+        key = (nested_serializer.field_name, tuple(nested_serializer.source_attrs))
+        plan = cls._relation_plans.get(key)
+        if plan is None:
+            plan = cls._relation_plans[key] = self._resolve_relation_plan(nested_serializer)
+        return plan
+
+    def _get_related_model_field(self, nested_serializer):
+        """Return model field through that nested serializer relate with
+        parent and type of relation.
+        :param nested_serializer:
+        :return: Tuple contained model field and relation type
+        (`forward`, `reverse`).
+        """
+        plan = self._get_relation_plan(nested_serializer)
+        return plan.model_field, plan.relation_type
+
     def _get_related_data(self, instance, nested_serializer):
         """Return value of foreign key and additional fields on the basis of
         which relation between parent and nested serializers is formed.
@@ -312,25 +642,17 @@ class WritableNestedParentSerializerMixin:
         :param nested_serializer:
         :return: Dictionary with fields values.
         """
-        related_model_field, relation_type = self._get_related_model_field(nested_serializer)
+        plan = self._get_relation_plan(nested_serializer)
 
-        data = {
-            lr_field.attname: getattr(instance, fr_field.attname)
-            for lr_field, fr_field in related_model_field.related_fields
-        }
+        data = {lr_attname: getattr(instance, fr_attname) for lr_attname, fr_attname in plan.related_fields}
 
-        if isinstance(related_model_field, GenericRelation):
-            data.update(
-                {
-                    related_model_field.content_type_field_name: ContentType.objects.get_for_model(instance),
-                }
-            )
-        if isinstance(related_model_field, CodedGenericRelation):
-            data.update(
-                {
-                    related_model_field.code_field: related_model_field.code,
-                }
+        if plan.content_type_field_name:
+            # Content types are cached by manager for the whole process,
+            # use `warm_up_content_types` to load them on startup.
+            data[plan.content_type_field_name] = ContentType.objects.get_for_model(
+                instance, for_concrete_model=plan.for_concrete_model
             )
+        data.update(plan.extra_data)
 
         return data
 
@@ -472,3 +794,28 @@ class RecursiveListSerializer(WritableListSerializer):
         if hasattr(self.child, "proxied"):
             self.child = self.child.proxied
         return super().update(instance, validated_data)
+
+
+class ExportListSerializer(serializers.ListSerializer):
+    """Prepare CommaSeparatedExportField fields of child for all objects
+    with single query per field, instead of query per object.
+    Can be set as `Meta.list_serializer_class` of child serializer.
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        instances = list(iterable)
+
+        prepared_fields = []
+        if all(isinstance(instance, models.Model) for instance in instances):
+            prepared_fields = [
+                field
+                for field in self.child._readable_fields
+                if isinstance(field, CommaSeparatedExportField) and field.prepare_batch(instances)
+            ]
+
+        try:
+            return [self.child.to_representation(item) for item in instances]
+        finally:
+            for field in prepared_fields:
+                field.clear_batch()
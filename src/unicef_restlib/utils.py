@@ -1,7 +1,11 @@
+import functools
 from collections.abc import Iterable, Mapping
 from itertools import chain
 
+from django.core.exceptions import FieldDoesNotExist
 from django.db.models import Manager, QuerySet
+from django.db.models.query import ModelIterable
+from django.db.models.query_utils import DeferredAttribute
 
 from rest_framework.fields import get_attribute
 
@@ -16,6 +20,224 @@ def pop_keys(d, keys):
     return res, rem
 
 
+# chunk size for querysets iterated lazily
+QUERYSET_CHUNK_SIZE = 2000
+
+# types which objects are iterated by path accessors, see `_is_collection`
+_collection_types = {}
+
+
+def _is_collection(instance):
+    """Check if attribute should be taken from each object of instance.
+    Result is cached per type as abstract base classes checks are slow.
+    """
+    instance_type = type(instance)
+    try:
+        return _collection_types[instance_type]
+    except KeyError:
+        result = isinstance(instance, (Iterable, QuerySet)) and not isinstance(instance, (Mapping, str))
+        _collection_types[instance_type] = result
+        return result
+
+
+def _get_path_attribute(instance, attr):
+    """Get attribute of instance, or attribute of each object if instance is iterable."""
+    if instance is None:
+        return None
+
+    if _is_collection(instance):
+        values = [_get_path_attribute(obj, attr) for obj in instance]
+        if all(isinstance(value, QuerySet) for value in values):
+            return chain(*values)
+        return values
+
+    instance = get_attribute(instance, [attr])
+    if isinstance(instance, Manager):
+        instance = instance.all()
+    return instance
+
+
+def _iterate_flat(instance):
+    if _is_collection(instance):
+        for obj in instance:
+            yield from _iterate_flat(obj)
+    elif instance is not None:
+        yield instance
+
+
+def _is_plain_attribute(model, field):
+    return type(getattr(model, field.attname, None)) is DeferredAttribute
+
+
+@functools.lru_cache(maxsize=1024)
+def get_values_lookup(model, attrs):
+    """Return ORM lookup for attributes path of model objects,
+    if path is a plain model field, maybe reached through to-one relations.
+    Values of such path can be loaded with `values_list` of the same length
+    as queryset, None stands for missed relation as `get_attribute_smart` does.
+    """
+    opts = model._meta
+    for i, attr in enumerate(attrs):
+        try:
+            field = opts.get_field(attr)
+        except FieldDoesNotExist:
+            return None
+
+        name = field.get_accessor_name() if field.auto_created and not field.concrete else field.name
+        if name != attr:
+            return None
+
+        if i == len(attrs) - 1:
+            if field.is_relation or not field.concrete or not _is_plain_attribute(opts.model, field):
+                return None
+        elif not (field.many_to_one or field.one_to_one) or field.related_model is None:
+            return None
+        else:
+            opts = field.related_model._meta
+
+    return "__".join(attrs) if attrs else None
+
+
+def _get_pushdown_queryset(queryset, attrs):
+    """Return queryset of attributes path values for not evaluated queryset objects,
+    or None if path can't be expressed as ORM lookup.
+    """
+    if queryset._result_cache is not None or queryset._iterable_class is not ModelIterable:
+        return None
+    # distinct would be applied to values instead of objects
+    if queryset.query.combinator or queryset.query.distinct:
+        return None
+
+    lookup = get_values_lookup(queryset.model, attrs)
+    if lookup is None:
+        return None
+    return queryset.values_list(lookup, flat=True)
+
+
+def _get_pushdown_values(queryset, attrs):
+    values = _get_pushdown_queryset(queryset, attrs)
+    return list(values) if values is not None else None
+
+
+def _iterate_lazy(instance, attrs, index=0):
+    """Yield flat values of attributes path starting from `index` attribute,
+    not evaluated querysets are iterated with `iterator()`.
+    """
+    if instance is None:
+        return
+
+    if isinstance(instance, QuerySet):
+        if instance._result_cache is None:
+            values = _get_pushdown_queryset(instance, attrs[index:]) if index < len(attrs) else None
+            if values is not None:
+                yield from (value for value in values.iterator(chunk_size=QUERYSET_CHUNK_SIZE) if value is not None)
+                return
+            instance = instance.iterator(chunk_size=QUERYSET_CHUNK_SIZE)
+        for obj in instance:
+            yield from _iterate_lazy(obj, attrs, index)
+        return
+
+    if _is_collection(instance):
+        for obj in instance:
+            yield from _iterate_lazy(obj, attrs, index)
+        return
+
+    if index == len(attrs):
+        yield instance
+        return
+
+    value = get_attribute(instance, [attrs[index]])
+    if isinstance(value, Manager):
+        value = value.all()
+    yield from _iterate_lazy(value, attrs, index + 1)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_path(path, flat=False, lazy=False):
+    """Compile dotted attributes path into function which returns
+    value of path for instance, in the same way as `get_attribute_smart`.
+
+    If `flat` is set, function returns flat list of values, nested lists
+    are expanded and None values skipped.
+    If `lazy` is set, function returns generator of flat values,
+    intermediate objects are not kept and querysets are iterated with `iterator()`.
+
+    Example usage:
+
+    get_ids = compile_path("instances.id")
+    get_ids({"instances": [{"id": 1}, {"id": 2}, {"id": 3}]})
+    """
+    if isinstance(path, str):
+        attrs = tuple(path.split(".")) if path else ()
+    else:
+        attrs = tuple(path)
+
+    if lazy:
+
+        def lazy_accessor(instance):
+            return _iterate_lazy(instance, attrs)
+
+        return lazy_accessor
+
+    if flat:
+        # attributes after each attribute of path
+        rest_attrs = [attrs[i:] for i in range(1, len(attrs) + 1)]
+
+        def flat_accessor(instance):
+            if isinstance(instance, QuerySet):
+                pushdown_values = _get_pushdown_values(instance, attrs)
+                if pushdown_values is not None:
+                    return [value for value in pushdown_values if value is not None]
+
+            # values of the whole path, loaded with queryset pushdown
+            result = []
+            values = list(_iterate_flat(instance))
+            for i, attr in enumerate(attrs):
+                next_values = []
+                for value in values:
+                    value = get_attribute(value, [attr])
+                    if isinstance(value, Manager):
+                        value = value.all()
+                        pushdown_values = _get_pushdown_values(value, rest_attrs[i])
+                        if pushdown_values is not None:
+                            result.extend(item for item in pushdown_values if item is not None)
+                            continue
+                    if _is_collection(value):
+                        next_values.extend(_iterate_flat(value))
+                    elif value is not None:
+                        next_values.append(value)
+                values = next_values
+            return result + values
+
+        return flat_accessor
+
+    def accessor(instance):
+        for i, attr in enumerate(attrs):
+            if instance is None:
+                break
+            if isinstance(instance, QuerySet):
+                pushdown_values = _get_pushdown_values(instance, attrs[i:])
+                if pushdown_values is not None:
+                    return pushdown_values
+            instance = _get_path_attribute(instance, attr)
+        return instance
+
+    return accessor
+
+
+def iterate_attribute_smart(instance, attrs):
+    """Lazy version of `get_attribute_smart`, yield flat values of attributes path
+    without None. Suitable for large relations, as querysets are iterated with `iterator()`.
+
+    Example usage:
+
+    ", ".join(set(iterate_attribute_smart(author, "books.reviews.user.username")))
+    """
+    if not isinstance(attrs, str):
+        attrs = tuple(attrs)
+    return compile_path(attrs, lazy=True)(instance)
+
+
 def get_attribute_smart(instance, attrs):
     """A bit smarter version of rest_framework.fields.get_attribute.
     Has ability to work with lists, so it can be used to look deep inside relations.
@@ -29,17 +251,6 @@ def get_attribute_smart(instance, attrs):
     if instance is None or not attrs:
         return instance
 
-    if isinstance(attrs, str):
-        attrs = attrs.split(".")
-
-    if isinstance(instance, (Iterable, QuerySet)) and not isinstance(instance, (Mapping, str)):
-        instance = list([get_attribute_smart(obj, [attrs[0]]) for obj in instance])
-        if all(map(lambda obj: isinstance(obj, QuerySet), instance)):
-            instance = chain(*instance)
-    else:
-        instance = get_attribute(instance, [attrs[0]])
-
-        if isinstance(instance, Manager):
-            instance = instance.all()
-
-    return get_attribute_smart(instance, attrs[1:])
+    if not isinstance(attrs, str):
+        attrs = tuple(attrs)
+    return compile_path(attrs)(instance)
@@ -1,15 +1,74 @@
 import functools
+import itertools
 import operator
 
+from django.core.exceptions import ImproperlyConfigured
 from django.db import ProgrammingError
-from django.db.models import Q
-from django.http import QueryDict
+from django.db.models import Exists, OuterRef, Prefetch, prefetch_related_objects, Q
+from django.http import QueryDict, StreamingHttpResponse
 
 from rest_framework import exceptions
+from rest_framework.renderers import JSONRenderer
+from rest_framework.serializers import BaseSerializer, ListSerializer
+from rest_framework.viewsets import ViewSetMixin
+
+from unicef_restlib.fields import CommaSeparatedExportField
+from unicef_restlib.search import LookupSearchBackend
+from unicef_restlib.serializers import ExportListSerializer
+
+
+def warm_up_serializer(serializer):
+    """Build fields of serializer and nested serializers,
+    so model metadata used by serializers is loaded before first request.
+    """
+    for field in serializer.fields.values():
+        if isinstance(field, ListSerializer):
+            field = field.child
+        if isinstance(field, BaseSerializer):
+            warm_up_serializer(field)
 
 
 class MultiSerializerViewSetMixin:
+    """Use serializer class depending on action.
+
+    `serializer_action_classes` is checked when view is created by router,
+    if `warm_up_serializers` is set, fields of all serializers are built
+    at the same time, instead of first request for each action.
+    """
+
     serializer_action_classes = {}
+    warm_up_serializers = False
+
+    @classmethod
+    def as_view(cls, *args, **kwargs):
+        if "_serializer_action_classes_checked" not in cls.__dict__:
+            cls.check_serializer_action_classes()
+            if cls.warm_up_serializers:
+                cls.warm_up_serializer_classes()
+            cls._serializer_action_classes_checked = True
+        return super().as_view(*args, **kwargs)
+
+    @classmethod
+    def check_serializer_action_classes(cls):
+        for action, serializer_class in cls.serializer_action_classes.items():
+            # metadata action is set by viewset for OPTIONS requests
+            if action != "metadata" and not callable(getattr(cls, action, None)):
+                raise ImproperlyConfigured(
+                    "{}.serializer_action_classes contains unknown action `{}`.".format(cls.__name__, action)
+                )
+            if not isinstance(serializer_class, type) or not issubclass(serializer_class, BaseSerializer):
+                raise ImproperlyConfigured(
+                    "{}.serializer_action_classes[`{}`] should be serializer class.".format(cls.__name__, action)
+                )
+
+    @classmethod
+    def warm_up_serializer_classes(cls):
+        serializer_classes = set(cls.serializer_action_classes.values())
+        if getattr(cls, "serializer_class", None):
+            serializer_classes.add(cls.serializer_class)
+
+        for serializer_class in serializer_classes:
+            warm_up_serializer(serializer_class(context={}))
 
     def get_serializer_class(self):
         try:
@@ -18,15 +77,49 @@ class MultiSerializerViewSetMixin:
             return super().get_serializer_class()
 
 
+class ParentViewRequest:
+    """Request used by parent viewsets: querystring of the original request
+    is hidden, so filters are not applied to parent querysets.
+    Everything else is delegated to the original request which is not modified,
+    so parents resolution is safe for concurrent requests handling.
+    """
+
+    def __init__(self, request):
+        self._original_request = request
+        self.query_params = QueryDict()
+
+    @property
+    def GET(self):
+        return self.query_params
+
+    def __getattr__(self, attr):
+        return getattr(self._original_request, attr)
+
+
 class NestedViewSetMixin:
     """Allow viewsets inheritance with correct filtering depending on parents."""
 
     parent = None
     parent_lookup_kwarg = None
     parent_lookup_field = None
+    # Parents chain and filter templates computed per viewset class.
+    _parents_cache = None
+    _parent_filter_templates_cache = None
+    # Fetch the whole parent chain with single query using select_related.
+    # Querysets and object permissions of upper parents are not checked then.
+    parent_chain_select_related = False
+    # Set for parent viewset instance to select related parents.
+    parent_chain_path = None
+    # Check that parents exist in querysets of parent viewsets using
+    # EXISTS subqueries, so it is done with the same query as listing.
+    parent_exists_filter = False
 
     @classmethod
     def _get_parents(cls):
+        parents = cls.__dict__.get("_parents_cache")
+        if parents is not None:
+            return parents
+
         parents = []
 
         try:
@@ -37,88 +130,310 @@ class NestedViewSetMixin:
         except AttributeError:
             pass
 
-        return parents
+        cls._parents_cache = tuple(parents)
+        return cls._parents_cache
+
+    @classmethod
+    def _get_parent_filter_templates(cls):
+        """Return tuple of orm lookup and url kwarg pairs for every parent.
+        Lookup is None if it can't be built because of missed `parent_lookup_field`.
+        """
+        templates = cls.__dict__.get("_parent_filter_templates_cache")
+        if templates is not None:
+            return templates
+
+        templates = []
+        child = cls
+        lookups = []
+        for parent in cls._get_parents():
+            lookups.append(child.parent_lookup_field)
+
+            lookup = None
+            if all(lookups):
+                lookup = "{}__{}".format("__".join(lookups), getattr(child.parent, "lookup_field", "pk"))
+            templates.append((lookup, child.parent_lookup_kwarg))
+
+            child = parent
+
+        cls._parent_filter_templates_cache = tuple(templates)
+        return cls._parent_filter_templates_cache
+
+    @classmethod
+    def _clear_parents_cache(cls):
+        cls._parents_cache = None
+        cls._parent_filter_templates_cache = None
 
     def get_parent_filter(self):
         return None
 
     def _get_parent_filters(self):
-        parents = self._get_parents()
+        templates = self._get_parent_filter_templates()
+        if not templates:
+            return {}
+
+        parent_filter = self.get_parent_filter()
+        if parent_filter is None:
+            filters, templates_to_apply = {}, templates
+        else:
+            filters, templates_to_apply = dict(parent_filter), templates[1:]
+
+        for lookup, url_kwarg in templates_to_apply:
+            assert lookup, "`parent_lookup_field` is required for {} parents filtering.".format(self.__class__.__name__)
+            filters[lookup] = self.kwargs.get(url_kwarg)
+
+        return filters
 
-        filters = {}
+    def _get_parent_exists_filters(self):
+        """Return EXISTS subqueries checking that parents from url are
+        available in querysets of parent viewsets.
+        """
+        filters = []
 
         child = self
         lookups = []
-        for parent in parents:
+        for parent in self._get_parents():
+            if not child.parent_lookup_field:
+                break
             lookups.append(child.parent_lookup_field)
 
-            parent_filter = None
-            if isinstance(child, NestedViewSetMixin):
-                parent_filter = child.get_parent_filter()
-
-            if parent_filter is None:
-                parent_filter = {
-                    "{}__{}".format("__".join(lookups), getattr(child.parent, "lookup_field", "pk")): self.kwargs.get(
-                        child.parent_lookup_kwarg
-                    )
+            parent_view = parent(
+                request=self.get_parent_request(), kwargs=self.kwargs, format_kwarg=None, action="parent"
+            )
+            parent_queryset = parent_view.get_queryset().filter(
+                **{
+                    getattr(parent, "lookup_field", "pk"): self.kwargs.get(child.parent_lookup_kwarg),
+                    "pk": OuterRef("__".join(lookups)),
                 }
-
-            filters.update(parent_filter)
+            )
+            filters.append(Exists(parent_queryset))
             child = parent
 
         return filters
 
+    def get_parent_request(self):
+        """Return request for parent viewsets, without querystring
+        to prevent incorrect filter results for parent views.
+        """
+        if isinstance(self.request, ParentViewRequest):
+            return self.request
+        return ParentViewRequest(self.request)
+
     def get_parent(self):
         parent_class = getattr(self, "parent", None)
         if not parent_class:
             return
 
+        kwargs = {}
+        if self.parent_chain_select_related and issubclass(parent_class, NestedViewSetMixin):
+            kwargs["parent_chain_path"] = parent_class._get_parent_chain_path()
+
         return parent_class(
-            request=self.request,
+            request=self.get_parent_request(),
             kwargs=self.kwargs,
             lookup_url_kwarg=self.parent_lookup_kwarg,
             action="parent",
+            **kwargs,
         )
 
+    @classmethod
+    def _get_parent_chain_path(cls):
+        """Return lookup from viewset model to the root model."""
+        lookups = []
+        child = cls
+        while getattr(child, "parent", None) and child.parent_lookup_field:
+            lookups.append(child.parent_lookup_field)
+            child = child.parent
+        return "__".join(lookups)
+
+    def _get_parent_objects_cache(self):
+        """Parent objects resolved during request, shared between
+        view, its permissions and serializers.
+        """
+        request = getattr(self.request, "_request", self.request)
+        if not hasattr(request, "_nested_parent_objects"):
+            request._nested_parent_objects = {}
+        return request._nested_parent_objects
+
+    def _cache_parent_chain(self, parent_class, parent_object):
+        """Put parents of parent object, fetched with select_related, to cache."""
+        cache = self._get_parent_objects_cache()
+        child, obj = parent_class, parent_object
+        while getattr(child, "parent", None) and child.parent_lookup_field and obj is not None:
+            obj = getattr(obj, child.parent_lookup_field)
+            key = (child.parent, child.parent_lookup_kwarg, self.kwargs.get(child.parent_lookup_kwarg))
+            cache.setdefault(key, obj)
+            child = child.parent
+
     def get_parent_object(self):
-        # remove request query for a while to prevent incorrect filter
-        # results for parent view
-        query = self.request._request.GET
-        self.request._request.GET = QueryDict()
+        if not self.parent or not self.kwargs:
+            return
 
-        try:
-            parent = self.get_parent()
-            if not parent or not self.kwargs:
-                return
-            parent_object = parent.get_object()
-        finally:
-            self.request._request.GET = query
+        cache = self._get_parent_objects_cache()
+        key = (self.parent, self.parent_lookup_kwarg, self.kwargs.get(self.parent_lookup_kwarg))
+        if key in cache:
+            return cache[key]
+
+        parent = self.get_parent()
+        parent_object = parent.get_object()
+
+        cache[key] = parent_object
+        if getattr(parent, "parent_chain_path", None):
+            self._cache_parent_chain(self.parent, parent_object)
 
         return parent_object
 
     def get_root_object(self):
-        # remove request query for a while to prevent incorrect filter
-        # results for parent view
-        query = self.request._request.GET
-        self.request._request.GET = QueryDict()
-
-        try:
-            parents = self._get_parents()
-            if not parents:
-                return
+        parents = self._get_parents()
+        if not parents:
+            return
 
-            pre_root = parents[-2] if len(parents) > 1 else self
-            root = parents[-1](request=self.request, kwargs=self.kwargs, lookup_url_kwarg=pre_root.parent_lookup_kwarg)
+        pre_root = parents[-2] if len(parents) > 1 else self
+        cache = self._get_parent_objects_cache()
+        key = (parents[-1], pre_root.parent_lookup_kwarg, self.kwargs.get(pre_root.parent_lookup_kwarg))
+        if key in cache:
+            return cache[key]
 
-            root_object = root.get_object()
-        finally:
-            self.request._request.GET = query
+        root = parents[-1](
+            request=self.get_parent_request(), kwargs=self.kwargs, lookup_url_kwarg=pre_root.parent_lookup_kwarg
+        )
+        root_object = root.get_object()
 
+        cache[key] = root_object
         return root_object
 
     def filter_queryset(self, queryset):
         queryset = super().filter_queryset(queryset)
         queryset = queryset.filter(**self._get_parent_filters())
+        if self.parent_exists_filter:
+            queryset = queryset.filter(*self._get_parent_exists_filters())
+        if self.parent_chain_path:
+            queryset = queryset.select_related(self.parent_chain_path)
+        return queryset
+
+
+class StreamingListMixin:
+    """Stream list as JSON array when all objects are requested,
+    e.g. `page_size=all` for OptionalPaginationMixin paginators.
+    Objects are fetched with `QuerySet.iterator` and serialized by chunks,
+    so memory usage doesn't depend on number of objects.
+    """
+
+    stream_chunk_size = 1000
+
+    def should_stream(self, request):
+        if request.accepted_renderer.format != "json":
+            return False
+
+        is_page_size_all = getattr(self.paginator, "is_page_size_all", None)
+        return bool(is_page_size_all and is_page_size_all(request))
+
+    def stream_queryset(self, queryset):
+        renderer = JSONRenderer()
+        # iterator ignores prefetch_related before Django 4.1, so chunks are prefetched explicitly
+        lookups = queryset._prefetch_related_lookups
+        objects = queryset.prefetch_related(None).iterator(chunk_size=self.stream_chunk_size)
+
+        yield b"["
+        first = True
+        while True:
+            chunk = list(itertools.islice(objects, self.stream_chunk_size))
+            if not chunk:
+                break
+
+            prefetch_related_objects(chunk, *lookups)
+            data = renderer.render(self.get_serializer(chunk, many=True).data)
+            if not first:
+                yield b","
+            # strip array brackets to join chunks into single array
+            yield data[1:-1]
+            first = False
+        yield b"]"
+
+    def list(self, request, *args, **kwargs):
+        if not self.should_stream(request):
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        return StreamingHttpResponse(self.stream_queryset(queryset), content_type="application/json")
+
+
+def merge_prefetch_lookups(existing, lookups):
+    """Return lookups which are not prefetched by `existing` lookups, ordered by depth.
+    Prefetch queryset is dropped if relation is traversed by other lookups,
+    otherwise Django fails as relation is prefetched in different ways.
+    """
+    existing_paths = {getattr(lookup, "prefetch_to", lookup) for lookup in existing}
+    paths = [getattr(lookup, "prefetch_to", lookup) for lookup in lookups]
+    all_paths = list(existing_paths) + paths
+
+    merged = {}
+    for lookup, path in zip(lookups, paths):
+        if path in existing_paths:
+            continue
+        if isinstance(lookup, Prefetch) and (
+            paths.count(path) > 1 or any(other.startswith(path + "__") for other in all_paths)
+        ):
+            lookup = path
+        merged.setdefault(path, lookup)
+    return sorted(merged.values(), key=lambda lookup: getattr(lookup, "prefetch_to", lookup).count("__"))
+
+
+class ExportPrefetchMixin:
+    """Prefetch relations used by CommaSeparatedExportField fields of serializer,
+    so objects are exported with query per relation instead of query per object.
+
+    Relations are prefetched only for `export_prefetch_actions` of viewsets
+    and always for views without actions.
+    """
+
+    export_prefetch_actions = ("list",)
+
+    def get_export_prefetch_lookups(self):
+        # parent viewsets are created without format and don't need full serializer context
+        serializer = self.get_serializer_class()(context={"request": getattr(self, "request", None), "view": self})
+        model = getattr(getattr(serializer, "Meta", None), "model", None)
+        if model is None:
+            return []
+
+        # fields prepared by list serializer for all objects don't need prefetch
+        list_serializer_class = getattr(serializer.Meta, "list_serializer_class", None)
+        batch = list_serializer_class is not None and issubclass(list_serializer_class, ExportListSerializer)
+
+        # relations read by other fields should be prefetched with all fields
+        read_paths = [
+            "__".join(field.source_attrs)
+            for field in serializer._readable_fields
+            if not isinstance(field, CommaSeparatedExportField) and field.source_attrs
+        ]
+
+        lookups = []
+        for field in serializer.fields.values():
+            if not isinstance(field, CommaSeparatedExportField):
+                continue
+            if batch and field.get_batch_lookups(model) is not None:
+                continue
+
+            for lookup in field.get_prefetch_lookups(model):
+                if isinstance(lookup, Prefetch) and any(
+                    path == lookup.prefetch_to or path.startswith(lookup.prefetch_to + "__") for path in read_paths
+                ):
+                    lookup = lookup.prefetch_to
+                lookups.append(lookup)
+        return lookups
+
+    def should_export_prefetch(self):
+        if not isinstance(self, ViewSetMixin):
+            return True
+        return getattr(self, "action", None) in self.export_prefetch_actions
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if not self.should_export_prefetch():
+            return queryset
+
+        lookups = merge_prefetch_lookups(queryset._prefetch_related_lookups, self.get_export_prefetch_lookups())
+        if lookups:
+            queryset = queryset.prefetch_related(*lookups)
         return queryset
 
 
@@ -132,53 +447,120 @@ class SafeTenantViewSetMixin:
             raise
 
 
+def _compile_query_filter(query_filter):
+    """Return function which builds Q object from querystring value
+    according to filter declaration.
+    """
+    if isinstance(query_filter, dict):
+        dict_queries = {
+            key: functools.reduce(
+                operator.and_, [Q(**{dict_filter: dict_value}) for dict_filter, dict_value in filters]
+            )
+            for key, filters in query_filter.items()
+            if filters
+        }
+
+        def dict_query(value):
+            return functools.reduce(operator.or_, [dict_queries.get(key, Q()) for key in value.split(",")])
+
+        return dict_query
+
+    if isinstance(query_filter, list):
+        lookups = tuple(query_filter)
+
+        def list_query(value):
+            return functools.reduce(operator.or_, [Q(**{lookup: value}) for lookup in lookups])
+
+        return list_query
+
+    if query_filter.endswith("__in"):
+
+        def in_query(value):
+            if value:
+                value = value.split(",")
+            return Q(**{query_filter: value})
+
+        return in_query
+
+    if query_filter.endswith("__isnotnull"):
+        isnull_filter = query_filter.replace("__isnotnull", "__isnull")
+
+        def isnotnull_query(value):
+            return Q(**{isnull_filter: not value})
+
+        return isnotnull_query
+
+    def query(value):
+        return Q(**{query_filter: value})
+
+    return query
+
+
+def compile_query_filters(filters):
+    """Compile filters declaration into dictionary of querystring param
+    and list of functions which build Q object for param value.
+    """
+    plan = {}
+    for param_filter, query_filter in filters:
+        plan.setdefault(param_filter, []).append(_compile_query_filter(query_filter))
+    return plan
+
+
 class QueryStringFilterMixin:
     """Mixin which allow to filter and search based on querystring filters"""
 
     search_param = "search"
+    search_backend = LookupSearchBackend
     filters = ()
     search_terms = ()
 
+    # Compiled filters declaration per view class, see `get_filters_plan`.
+    _filters_plan = None
+
+    @classmethod
+    def get_filters_plan(cls, filters):
+        """Return compiled filters. Class filters are compiled once."""
+        if filters is not cls.filters:
+            return compile_query_filters(filters)
+
+        cached = cls.__dict__.get("_filters_plan")
+        if cached is None or cached[0] is not filters:
+            cached = cls._filters_plan = (filters, compile_query_filters(filters))
+        return cached[1]
+
     def filter_params(self, filters=None):
-        filters = filters or self.filters
+        plan = self.get_filters_plan(filters or self.filters)
         queries = []
-        for param_filter, query_filter in filters:
-            if param_filter in self.request.query_params:
-                value = self.request.query_params.get(param_filter)
-                if value in ["true", "false"]:
-                    value = True if value == "true" else False
-                or_queries = []
-                if isinstance(query_filter, dict):
-                    values = value.split(",")
-                    for value in values:
-                        filter_list = query_filter.get(value, [])
-                        subqueries = [Q(**{dict_filter: dict_value}) for dict_filter, dict_value in filter_list]
-                        or_queries.append(functools.reduce(operator.and_, subqueries))
-                    queries.append(functools.reduce(operator.or_, or_queries))
-                elif isinstance(query_filter, list):
-                    subq = [Q(**{filter: value}) for filter in query_filter]
-                    queries.append(functools.reduce(operator.or_, subq))
-                else:
-                    if query_filter.endswith("__in") and value:
-                        value = value.split(",")
-                    elif query_filter.endswith("__isnotnull"):
-                        query_filter = query_filter.replace(
-                            "__isnotnull",
-                            "__isnull",
-                        )
-                        value = not value
-                    queries.append(Q(**{query_filter: value}))
+        query_params = self.request.query_params
+        for param_filter in query_params:
+            if param_filter not in plan:
+                continue
+
+            value = query_params.get(param_filter)
+            if value in ["true", "false"]:
+                value = True if value == "true" else False
+            queries.extend(query(value) for query in plan[param_filter])
         return queries
 
+    def get_search_backend(self):
+        return self.search_backend()
+
     def search_params(self, search_terms=None):
         search_terms = search_terms or self.search_terms
+        if self.search_param not in self.request.query_params:
+            return Q()
+
+        search_term = self.request.query_params.get(self.search_param)
+        return self.get_search_backend().get_query(search_terms, search_term)
+
+    def search_queryset(self, queryset, search_terms=None):
+        """Apply search backend specific filtering, annotations and ordering."""
+        search_terms = search_terms or self.search_terms
+        if self.search_param not in self.request.query_params:
+            return queryset
+
         search_term = self.request.query_params.get(self.search_param)
-        search_query = Q()
-        if self.search_param in self.request.query_params:
-            for param_filter in search_terms:
-                q = Q(**{param_filter: search_term})
-                search_query = search_query | q
-        return search_query
+        return self.get_search_backend().filter_queryset(queryset, search_terms, search_term)
 
     def get_queryset(self):
         qs = super().get_queryset()
@@ -192,4 +574,5 @@ class QueryStringFilterMixin:
             if queries:
                 expression = functools.reduce(operator.and_, queries)
                 qs = qs.filter(expression)
+            qs = self.search_queryset(qs)
         return qs
@@ -9,6 +9,7 @@ from unicef_restlib.fields import (
 )
 from unicef_restlib.serializers import (
     DeletableSerializerMixin,
+    ExportListSerializer,
     PKSerializerMixin,
     RecursiveListSerializer,
     UserContextSerializerMixin,
@@ -103,6 +104,31 @@ class BookSerializer(DeletableSerializerMixin, WritableNestedChildSerializerMixi
         fields = ("id", "name", "sku_number", "author", "genre", "author_description")
 
 
+class BookBulkSerializer(DeletableSerializerMixin, WritableNestedChildSerializerMixin, serializers.ModelSerializer):
+    class Meta(DeletableSerializerMixin.Meta, WritableNestedChildSerializerMixin.Meta):
+        model = Book
+        fields = ("id", "name", "sku_number", "genre")
+        bulk_write = True
+
+
+class BookLoadPayloadSerializer(
+    DeletableSerializerMixin, WritableNestedChildSerializerMixin, serializers.ModelSerializer
+):
+    class Meta(DeletableSerializerMixin.Meta, WritableNestedChildSerializerMixin.Meta):
+        model = Book
+        fields = ("id", "name", "sku_number", "genre")
+        load_payload_only = True
+        delete_chunk_size = 1
+
+
+class ActivityLoadPayloadSerializer(WritableNestedChildSerializerMixin, serializers.ModelSerializer):
+    class Meta(WritableNestedChildSerializerMixin.Meta):
+        model = Activity
+        fields = ("id", "activity_type", "activity_count")
+        load_payload_only = True
+        raw_delete = True
+
+
 class AuthorSerializer(WritableNestedParentSerializerMixin, serializers.ModelSerializer):
     books = BookSerializer(many=True, required=False)
     activities = ActivitySerializer(many=True, required=False)
@@ -116,12 +142,44 @@ class AuthorSerializer(WritableNestedParentSerializerMixin, serializers.ModelSer
         fields = "__all__"
 
 
+class AuthorBulkSerializer(WritableNestedParentSerializerMixin, serializers.ModelSerializer):
+    books = BookBulkSerializer(many=True, required=False)
+
+    class Meta:
+        model = Author
+        fields = ("id", "first_name", "last_name", "books")
+
+
+class AuthorLoadPayloadSerializer(WritableNestedParentSerializerMixin, serializers.ModelSerializer):
+    books = BookLoadPayloadSerializer(many=True, required=False)
+    activities = ActivityLoadPayloadSerializer(many=True, required=False)
+
+    class Meta:
+        model = Author
+        fields = ("id", "first_name", "last_name", "books", "activities")
+
+
 class AuthorMetaSerializer(serializers.ModelSerializer):
     class Meta:
         model = Author
         fields = "__all__"
 
 
+class AuthorExportSerializer(serializers.ModelSerializer):
+    review_ratings = CommaSeparatedExportField(source="reviews", export_attr="rating")
+    book_names = CommaSeparatedExportField(source="books", export_attr="name")
+    book_isbns = CommaSeparatedExportField(source="books", export_attr="isbn.code")
+
+    class Meta:
+        model = Author
+        fields = ("id", "first_name", "last_name", "review_ratings", "book_names", "book_isbns")
+
+
+class AuthorExportBatchSerializer(AuthorExportSerializer):
+    class Meta(AuthorExportSerializer.Meta):
+        list_serializer_class = ExportListSerializer
+
+
 class AuthorPKSerializer(PKSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Author
@@ -148,6 +206,12 @@ class ISBNSerializer(WritableNestedChildSerializerMixin, serializers.ModelSerial
         fields = ("code",)
 
 
+class ISBNCodeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ISBN
+        fields = ("id", "code")
+
+
 class BookISBNSerializer(WritableNestedParentSerializerMixin, serializers.ModelSerializer):
     isbn = ISBNSerializer(required=False, allow_null=True)
 
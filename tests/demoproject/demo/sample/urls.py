@@ -49,14 +49,23 @@ router.register(
 
 nested = NestedComplexRouter(router, r"authors", lookup="author")
 nested.register(r"books", views.BookViewSet, basename="author-books")
+nested.register(r"nested-books", views.AuthorBookNestedViewSet, basename="author-nested-books")
+
+book_nested = NestedComplexRouter(nested, r"nested-books", lookup="book")
+book_nested.register(r"isbns", views.BookISBNNestedViewSet, basename="book-isbns")
 
 urlpatterns = [
     re_path(r"^authors/paginate/$", views.AuthorPaginateView.as_view(), name="authors-paginate"),
+    re_path(r"^authors/paginate/stream/$", views.AuthorStreamPaginateView.as_view(), name="authors-paginate-stream"),
+    re_path(r"^authors/paginate/keyset/$", views.AuthorKeysetPaginateView.as_view(), name="authors-paginate-keyset"),
+    re_path(r"^authors/export/$", views.AuthorExportView.as_view(), name="authors-export"),
+    re_path(r"^authors/export/batch/$", views.AuthorExportBatchView.as_view(), name="authors-export-batch"),
     re_path(r"^authors/meta/cru/$", views.AuthorMetaCRUListView.as_view(), name="authors-meta-cru-list"),
     re_path(r"^authors/meta/fsm/$", views.AuthorMetaFSMListView.as_view(), name="authors-meta-fsm-list"),
     re_path(r"^authors/meta/fsm/(?P<pk>\d+)/$", views.AuthorMetaFSMView.as_view(), name="authors-meta-fsm"),
     re_path(r"^reviews/meta/fsm/(?P<pk>\d+)/$", views.ReviewMetaFSMView.as_view(), name="review-meta-fsm"),
     re_path(r"^list", view=views.AuthorView.as_view(), name="list"),
     re_path(r"^", include(nested.urls)),
+    re_path(r"^", include(book_nested.urls)),
     re_path(r"^", include(router.urls)),
 ]
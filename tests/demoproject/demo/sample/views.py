@@ -3,18 +3,20 @@ from django.db import ProgrammingError
 from rest_framework import viewsets
 from rest_framework.generics import ListAPIView, RetrieveUpdateAPIView
 
-from unicef_restlib.pagination import DynamicPageNumberPagination
+from unicef_restlib.pagination import DynamicPageNumberPagination, KeysetPagination
 from unicef_restlib.permissions import IsSuperUser
 from unicef_restlib.views import (
+    ExportPrefetchMixin,
     MultiSerializerViewSetMixin,
     NestedViewSetMixin,
     QueryStringFilterMixin,
     SafeTenantViewSetMixin,
+    StreamingListMixin,
 )
 
 from demo.sample import serializers
 from demo.sample.metadata import CRUMetadata, FSMMetadata
-from demo.sample.models import Author, Book, Review
+from demo.sample.models import Author, Book, ISBN, Review
 
 
 class AuthorViewSet(viewsets.ModelViewSet):
@@ -44,6 +46,20 @@ class AuthorPaginateView(ListAPIView):
     pagination_class = DynamicPageNumberPagination
 
 
+class AuthorStreamPaginateView(StreamingListMixin, ListAPIView):
+    queryset = Author.objects.order_by("pk")
+    serializer_class = serializers.AuthorMetaSerializer
+    pagination_class = DynamicPageNumberPagination
+    stream_chunk_size = 3
+
+
+class AuthorKeysetPaginateView(ListAPIView):
+    queryset = Author.objects.all()
+    serializer_class = serializers.AuthorMetaSerializer
+    pagination_class = KeysetPagination
+    keyset_ordering = ("-active", "last_name")
+
+
 class BookViewSet(viewsets.ModelViewSet):
     queryset = Book.objects.all()
     serializer_class = serializers.BookSerializer
@@ -93,6 +109,31 @@ class BookNoParentNestedViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
         serializer.save(author=parent)
 
 
+class AuthorBookNestedViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
+    queryset = Book.objects.filter(author__active=True)
+    serializer_class = serializers.BookSerializer
+
+
+class BookISBNNestedViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
+    queryset = ISBN.objects.all()
+    serializer_class = serializers.ISBNCodeSerializer
+    parent_chain_select_related = True
+    parent_exists_filter = True
+
+    def perform_create(self, serializer, **kwargs):
+        serializer.save(book=self.get_parent_object())
+
+
+class AuthorExportView(ExportPrefetchMixin, ListAPIView):
+    queryset = Author.objects.order_by("pk")
+    serializer_class = serializers.AuthorExportSerializer
+
+
+class AuthorExportBatchView(ExportPrefetchMixin, ListAPIView):
+    queryset = Author.objects.order_by("pk")
+    serializer_class = serializers.AuthorExportBatchSerializer
+
+
 class AuthorView(QueryStringFilterMixin, ListAPIView):
     queryset = Author.objects.all()
     serializer_class = serializers.AuthorSerializer
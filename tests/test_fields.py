@@ -1,13 +1,21 @@
+import copy
 from collections import OrderedDict
 
 from django.forms.models import model_to_dict
+from django.utils import translation
+
+from rest_framework import serializers
 
 import pytest
 from unittest.mock import Mock, patch
 
 from tests.factories import FileTypeFactory
+from unicef_restlib.fields import CommaSeparatedExportField, DynamicChoicesField
 
+from demo.sample.fields import FileTypeCachedModelChoiceField, FileTypeModelChoiceField
+from demo.sample.models import Author, Book, FileType, ISBN, Review
 from demo.sample.serializers import (
+    AuthorExportSerializer,
     AuthorSerializer,
     BookSeparatedSerializer,
     BookSeparatedWriteSerializer,
@@ -204,3 +212,137 @@ def test_model_choice_field_invalid_serializer():
     assert "file_type" in invalid_serializer.errors
     s = 'Invalid option "{pk_value}" - option is not available.'.format(pk_value=file_type.pk)
     assert s in invalid_serializer.errors["file_type"]
+
+
+def test_model_choice_field_cached_choices(django_assert_num_queries):
+    file_type = FileTypeFactory(code="image")
+    queryset = FileType.objects.filter(code__in=["image", "doc"])
+
+    with django_assert_num_queries(1):
+        assert FileTypeCachedModelChoiceField(queryset=queryset).choices == {file_type.pk: file_type.name}
+        assert FileTypeCachedModelChoiceField(queryset=queryset).choices == {file_type.pk: file_type.name}
+
+    # choices are invalidated on save
+    other_file_type = FileTypeFactory(code="doc")
+    with django_assert_num_queries(1):
+        assert FileTypeCachedModelChoiceField(queryset=queryset).choices == {
+            file_type.pk: file_type.name,
+            other_file_type.pk: other_file_type.name,
+        }
+
+    # and on delete
+    other_file_type.delete()
+    with django_assert_num_queries(1):
+        assert FileTypeCachedModelChoiceField(queryset=queryset).choices == {file_type.pk: file_type.name}
+
+    # cache is used only if enabled
+    with django_assert_num_queries(1):
+        assert FileTypeModelChoiceField(queryset=queryset).choices == {file_type.pk: file_type.name}
+
+
+def test_model_choice_field_cached_choices_queryset(django_assert_num_queries):
+    file_type = FileTypeFactory(code="image")
+    other_file_type = FileTypeFactory(code="doc")
+
+    assert FileTypeCachedModelChoiceField(queryset=FileType.objects.filter(code="image")).choices == {
+        file_type.pk: file_type.name
+    }
+    assert FileTypeCachedModelChoiceField(queryset=FileType.objects.filter(code="doc")).choices == {
+        other_file_type.pk: other_file_type.name
+    }
+    assert FileTypeCachedModelChoiceField(queryset=FileType.objects.none()).choices == {}
+
+
+def test_model_choice_field_cached_choices_language():
+    class LanguageCachedModelChoiceField(FileTypeCachedModelChoiceField):
+        def get_choice(self, obj):
+            return obj.pk, translation.get_language()
+
+    file_type = FileTypeFactory(code="image")
+    queryset = FileType.objects.filter(code="image")
+
+    with translation.override("en"):
+        assert LanguageCachedModelChoiceField(queryset=queryset).choices == {file_type.pk: "en"}
+    with translation.override("fr"):
+        assert LanguageCachedModelChoiceField(queryset=queryset).choices == {file_type.pk: "fr"}
+
+
+def test_model_choice_field_batch_list_serializer(django_assert_num_queries):
+    file_type = FileTypeFactory(code="image")
+    other_file_type = FileTypeFactory(code="wrong")
+    data = [{"file_type": file_type.pk} for __ in range(10)] + [{"file_type": other_file_type.pk}, {"file_type": 404}]
+
+    serializer = ImageFileTypeSerializer(data=data, many=True)
+    with django_assert_num_queries(1):
+        assert not serializer.is_valid()
+
+    assert serializer.errors[:10] == [{}] * 10
+    s = 'Invalid option "{pk_value}" - option is not available.'
+    assert serializer.errors[10] == {"file_type": [s.format(pk_value=other_file_type.pk)]}
+    assert serializer.errors[11] == {"file_type": [s.format(pk_value=404)]}
+
+
+def test_model_choice_field_batch_many(django_assert_num_queries):
+    class FileTypesSerializer(serializers.Serializer):
+        file_types = FileTypeModelChoiceField(queryset=FileType.objects.all(), many=True)
+
+    file_types = [FileTypeFactory(code="image"), FileTypeFactory(code="doc")]
+
+    serializer = FileTypesSerializer(data={"file_types": [file_type.pk for file_type in file_types] * 5})
+    with django_assert_num_queries(1):
+        assert serializer.is_valid()
+    assert serializer.validated_data["file_types"] == file_types * 5
+
+    serializer = FileTypesSerializer(data={"file_types": [file_types[0].pk, "wrong"]})
+    assert not serializer.is_valid()
+    assert serializer.errors == {"file_types": ["Incorrect type. Expected pk value, received str."]}
+
+
+def test_comma_separated_export_field_prefetch_lookups():
+    fields = AuthorExportSerializer().fields
+
+    [reviews] = fields["review_ratings"].get_prefetch_lookups(Author)
+    assert reviews.prefetch_to == "reviews"
+    assert reviews.queryset.query.deferred_loading == ({"id", "rating", "author"}, False)
+
+    [isbn] = fields["book_isbns"].get_prefetch_lookups(Author)
+    assert isbn.prefetch_to == "books__isbn"
+    assert isbn.queryset.query.deferred_loading == ({"id", "code", "book"}, False)
+
+    assert AuthorSerializer().fields["review_ratings"].get_prefetch_lookups(Author)
+    field = CommaSeparatedExportField()
+    field.bind("first_name", AuthorExportSerializer())
+    assert field.get_prefetch_lookups(Author) == []
+
+
+def test_comma_separated_export_field_batch_lookups():
+    fields = AuthorExportSerializer().fields
+    assert fields["review_ratings"].get_batch_lookups(Author) == (Review, "author", "rating")
+    assert fields["book_isbns"].get_batch_lookups(Author) == (Book, "author", "isbn__code")
+
+    query = fields["review_ratings"].get_batch_query(Author, [1])
+    assert query._fields == ("author__pk", "pk", "rating")
+
+    field = CommaSeparatedExportField(export_attr="name")
+    field.bind("book", AuthorExportSerializer())
+    assert field.get_batch_lookups(ISBN) is None
+
+
+def test_dynamic_choices_field_choices_map():
+    field = BookSerializer().fields["genre"]
+    assert field.choices is Book.GENRE_CHOICES
+    assert field.choice_strings_to_values is Book.GENRE_CHOICES._display_map
+    assert field.to_internal_value("western") == "Western"
+
+    field = DynamicChoicesField(Book.GENRE_CHOICES)
+    assert copy.deepcopy(field).choices is Book.GENRE_CHOICES
+
+    field = ReviewMetaSerializer().fields["rating"]
+    choice_strings_to_values = field.choice_strings_to_values
+    assert choice_strings_to_values == {"1": 1, "2": 2, "3": 3, "4": 4, "5": 5}
+    assert field.choice_strings_to_values is choice_strings_to_values
+
+    # map is rebuilt when choices are changed
+    field.choices = {6: 6}
+    assert field.choice_strings_to_values == {"6": 6}
+    assert field.to_internal_value("6") == 6
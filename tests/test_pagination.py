@@ -1,8 +1,23 @@
+import datetime
+import json
+from base64 import urlsafe_b64encode
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework.request import Request
 
 import pytest
+from unittest.mock import Mock, patch
+
+from tests.factories import AuthorFactory, BookFactory, ReviewFactory, UserFactory
+from unicef_restlib.pagination import DynamicPageNumberPagination, KeysetPagination
 
 from demo.sample.models import Author
+from demo.sample.serializers import AuthorExportSerializer
+from demo.sample.views import AuthorStreamPaginateView
 
 pytestmark = pytest.mark.django_db
 
@@ -33,3 +48,177 @@ def test_view_paginate_optional(client, authors):
     data = response.json()
     assert "results" not in data
     assert len(data) == author_qs.count()
+
+
+def test_view_paginate_keyset(client, authors):
+    for i in range(12):
+        authors.get(last_name="Smith" if i % 2 else "Doe", active=i % 3 != 0)
+    expected = list(Author.objects.order_by("-active", "last_name", "pk").values_list("pk", flat=True))
+    url = reverse("sample:authors-paginate-keyset")
+
+    # first page
+    response = client.get("{}?page_size=5".format(url))
+    assert response.status_code == 200
+    data = response.json()
+    assert "count" not in data
+    assert data["previous"] is None
+    assert [author["id"] for author in data["results"]] == expected[:5]
+
+    # walk forward
+    seen = [author["id"] for author in data["results"]]
+    while data["next"]:
+        data = client.get(data["next"]).json()
+        seen.extend(author["id"] for author in data["results"])
+    assert seen == expected
+
+    # walk back
+    assert [author["id"] for author in data["results"]] == expected[10:]
+    data = client.get(data["previous"]).json()
+    assert [author["id"] for author in data["results"]] == expected[5:10]
+    data = client.get(data["previous"]).json()
+    assert [author["id"] for author in data["results"]] == expected[:5]
+    assert data["previous"] is None
+
+
+def test_paginate_keyset_string_ordering(rf, authors):
+    for __ in range(3):
+        authors.get()
+    paginator = KeysetPagination()
+    queryset = Author.objects.all()
+    page = paginator.paginate_queryset(queryset, Request(rf.get("/")), view=Mock(keyset_ordering="-last_name"))
+    assert [author.pk for author in page] == list(queryset.order_by("-last_name", "pk").values_list("pk", flat=True))
+
+
+def test_paginate_keyset_datetime(rf):
+    now = timezone.now()
+    users = [UserFactory(date_joined=now + datetime.timedelta(microseconds=100 * i)) for i in range(6)]
+    expected = [user.pk for user in reversed(users)]
+    view = Mock(keyset_ordering=("-date_joined",))
+    queryset = get_user_model().objects.all()
+
+    url = "/?page_size=2"
+    seen = []
+    while url:
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(queryset, Request(rf.get(url)), view=view)
+        seen.extend(user.pk for user in page)
+        url = paginator.get_next_link()
+    assert seen == expected
+
+    # walk back
+    paginator = KeysetPagination()
+    url = "/?page_size=2&cursor={}".format(paginator.encode_keyset([users[1].date_joined, users[1].pk], True))
+    page = paginator.paginate_queryset(queryset, Request(rf.get(url)), view=view)
+    assert [user.pk for user in page] == expected[2:4]
+
+
+def test_view_paginate_keyset_optional(client, authors):
+    for __ in range(12):
+        authors.get()
+
+    response = client.get("{}?page_size=all".format(reverse("sample:authors-paginate-keyset")))
+    assert response.status_code == 200
+    assert len(response.json()) == 12
+
+
+def test_view_paginate_keyset_invalid_cursor(client, author):
+    response = client.get("{}?cursor=wrong".format(reverse("sample:authors-paginate-keyset")))
+    assert response.status_code == 404
+
+
+def test_view_paginate_keyset_invalid_cursor_values(client, author):
+    cursor = urlsafe_b64encode(json.dumps({"v": [True, "x", "abc"], "r": False}).encode("utf-8")).decode("ascii")
+    response = client.get(reverse("sample:authors-paginate-keyset"), {"cursor": cursor})
+    assert response.status_code == 404
+
+
+def test_view_paginate_stream_all(client, authors):
+    url = reverse("sample:authors-paginate-stream")
+    response = client.get("{}?page_size=all".format(url))
+    assert response.streaming
+    assert json.loads(b"".join(response.streaming_content)) == []
+
+    for __ in range(7):
+        authors.get()
+
+    response = client.get("{}?page_size=all".format(url))
+    assert response.status_code == 200
+    assert response.streaming
+    data = json.loads(b"".join(response.streaming_content))
+    assert [author["id"] for author in data] == list(Author.objects.order_by("pk").values_list("pk", flat=True))
+
+    # paginated
+    response = client.get("{}?page_size=5".format(url))
+    assert not response.streaming
+    assert len(response.json()["results"]) == 5
+
+
+def test_stream_queryset_prefetch(rf, django_assert_num_queries):
+    for author in AuthorFactory.create_batch(7):
+        BookFactory(author=author)
+        ReviewFactory(author=author)
+    view = AuthorStreamPaginateView(
+        request=Request(rf.get("/")), format_kwarg=None, serializer_class=AuthorExportSerializer
+    )
+    queryset = Author.objects.order_by("pk").prefetch_related("books", "reviews", "books__isbn")
+
+    # authors and relations for each of 3 chunks
+    with django_assert_num_queries(10):
+        data = json.loads(b"".join(view.stream_queryset(queryset)))
+    assert [author["id"] for author in data] == list(queryset.values_list("pk", flat=True))
+
+
+def test_paginate_count_cached(authors, django_assert_num_queries):
+    for __ in range(3):
+        authors.get()
+    cache.clear()
+    paginator = DynamicPageNumberPagination()
+    paginator.count_strategy = DynamicPageNumberPagination.COUNT_CACHED
+    queryset = Author.objects.filter(active=True)
+
+    with django_assert_num_queries(1):
+        assert paginator.get_count(queryset) == 3
+    authors.get()
+    with django_assert_num_queries(0):
+        assert paginator.get_count(queryset) == 3
+    with django_assert_num_queries(1):
+        assert paginator.get_count(queryset.filter(first_name="demo")) == 0
+
+
+@pytest.mark.parametrize(
+    "count_strategy",
+    [
+        DynamicPageNumberPagination.COUNT_EXACT,
+        DynamicPageNumberPagination.COUNT_CACHED,
+        DynamicPageNumberPagination.COUNT_APPROXIMATE,
+    ],
+)
+def test_paginate_count_list(rf, count_strategy):
+    paginator = DynamicPageNumberPagination()
+    paginator.count_strategy = count_strategy
+    request = Request(rf.get("/"))
+
+    assert paginator.paginate_queryset(list(range(30)), request) == list(range(10))
+    response = paginator.get_paginated_response([])
+    assert response.data["count"] == 30
+    assert paginator.get_count(list(range(30))) == 30
+
+
+def test_paginate_count_approximate(rf, authors):
+    for __ in range(3):
+        authors.get()
+    paginator = DynamicPageNumberPagination()
+    paginator.count_strategy = DynamicPageNumberPagination.COUNT_APPROXIMATE
+    request = Request(rf.get("/"))
+
+    # estimate is not available for sqlite
+    paginator.paginate_queryset(Author.objects.order_by("pk"), request)
+    response = paginator.get_paginated_response([])
+    assert response.data["count"] == 3
+    assert response.data["count_approximate"] is False
+
+    with patch.object(DynamicPageNumberPagination, "get_estimated_count", Mock(return_value=20000)):
+        paginator.paginate_queryset(Author.objects.order_by("pk"), request)
+    response = paginator.get_paginated_response([])
+    assert response.data["count"] == 20000
+    assert response.data["count_approximate"] is True
@@ -0,0 +1,48 @@
+from importlib.util import find_spec
+
+from django.db.models import Q
+
+import pytest
+
+from unicef_restlib.search import FullTextSearchBackend, get_search_field, LookupSearchBackend, TrigramSearchBackend
+
+from demo.sample.models import Author
+
+requires_psycopg = pytest.mark.skipif(
+    not (find_spec("psycopg") or find_spec("psycopg2")), reason="PostgreSQL driver is not installed"
+)
+
+
+def test_get_search_field():
+    assert get_search_field("first_name__icontains") == "first_name"
+    assert get_search_field("books__name__istartswith") == "books__name"
+    assert get_search_field("books__name") == "books__name"
+    assert get_search_field("first_name") == "first_name"
+
+
+def test_lookup_backend():
+    backend = LookupSearchBackend()
+    query = backend.get_query(("first_name__icontains", "last_name__icontains"), "joe")
+    assert query == Q(first_name__icontains="joe") | Q(last_name__icontains="joe")
+    queryset = Author.objects.all()
+    assert backend.filter_queryset(queryset, ("first_name__icontains",), "joe") is queryset
+
+
+@requires_psycopg
+def test_full_text_backend():
+    backend = FullTextSearchBackend()
+    assert backend.get_query(("first_name",), "joe") == Q()
+
+    queryset = backend.filter_queryset(Author.objects.order_by("pk"), ("first_name__icontains", "last_name"), "joe")
+    assert "search_vector" in queryset.query.annotations
+    assert "search_rank" in queryset.query.annotations
+    assert queryset.query.order_by[1:] == ("pk",)
+
+
+def test_trigram_backend():
+    backend = TrigramSearchBackend()
+    query = backend.get_query(("first_name__icontains", "last_name"), "joe")
+    assert query == Q(first_name__trigram_similar="joe") | Q(last_name__trigram_similar="joe")
+
+    queryset = backend.filter_queryset(Author.objects.all(), ("first_name", "last_name"), "joe")
+    assert "search_similarity" in queryset.query.annotations
@@ -1,13 +1,19 @@
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from rest_framework import serializers
 
 import pytest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
+
+from unicef_restlib.serializers import warm_up_content_types, WritableListSerializer
 
 from demo.sample.models import Activity, Author, Book, Category, Image, ISBN, Review
 from demo.sample.serializers import (
+    AuthorBulkSerializer,
     AuthorIDSerializer,
+    AuthorLoadPayloadSerializer,
     AuthorPKSerializer,
     AuthorReviewsSerializer,
     AuthorSerializer,
@@ -349,7 +355,7 @@ def test_many_nesting_raises(author, books):
         data={
             "books": [
                 {"id": book_1.pk, "name": "Scary Tales", "sku_number": "123"},
-                {"id": book_2.pk, "name": "Scary Tales", "sku_number": "123"},
+                {"id": book_2.pk, "name": "Scary Tales", "sku_number": "456"},
             ]
         },
     )
@@ -515,6 +521,22 @@ def test_generic_create_through_update(author):
     ).exists()
 
 
+def test_generic_content_type_warm_up(author):
+    ContentType.objects.clear_cache()
+    content_types = warm_up_content_types()
+    assert content_types[Author] == ContentType.objects.get_for_model(Author)
+
+    serializer = AuthorSerializer(
+        author, partial=True, data={"activities": [{"activity_type": "view", "activity_count": 10}]}
+    )
+    serializer.is_valid(raise_exception=True)
+    with CaptureQueriesContext(connection) as ctx:
+        serializer.save()
+
+    assert not [q for q in ctx.captured_queries if "django_content_type" in q["sql"]]
+    assert Activity.objects.filter(content_type=content_types[Author], object_id=author.pk).exists()
+
+
 def test_coded_generic_representation(author, images):
     image_profile = images.get(author=author, code="author_profile_image")
     image_full = images.get(author=author, code="author_full_image")
@@ -583,6 +605,96 @@ def test_unique_for_new(author):
     assert not Book.objects.filter(author=author).exists()
 
 
+def test_unique_same_instance(author, book):
+    serializer = AuthorSerializer(
+        author,
+        partial=True,
+        data={"books": [{"id": book.pk, "name": "Scary Tales", "sku_number": book.sku_number}]},
+    )
+
+    serializer.is_valid(raise_exception=True)
+    serializer.save()
+    assert Book.objects.get(pk=book.pk).name == "Scary Tales"
+
+
+def test_unique_batched(author, books, django_assert_num_queries):
+    book_1 = books.get(author=author)
+    book_2 = books.get(author=author)
+    serializer = AuthorSerializer(
+        author,
+        partial=True,
+        data={
+            "books": [
+                {"id": book_1.pk, "sku_number": book_2.sku_number},
+                {"name": "Scary Tales 1", "sku_number": "123"},
+                {"name": "Scary Tales 2", "sku_number": "456"},
+                {"name": "Scary Tales 3", "sku_number": "123"},
+            ]
+        },
+    )
+
+    serializer.is_valid(raise_exception=True)
+    with django_assert_num_queries(11):
+        with pytest.raises(serializers.ValidationError) as err:
+            serializer.save()
+
+    assert err.value.detail == {
+        "books": [
+            {"sku_number": ["book with this sku number already exists."]},
+            {},
+            {},
+            {"sku_number": ["book with this sku number already exists."]},
+        ]
+    }
+    assert Book.objects.filter(author=author).count() == 2
+
+
+@pytest.mark.parametrize("serializer_class", [AuthorSerializer, AuthorBulkSerializer])
+def test_unique_freed_by_previous_update(author, books, serializer_class):
+    book_1 = books.get(author=author)
+    book_2 = books.get(author=author)
+    serializer = serializer_class(
+        author,
+        partial=True,
+        data={"books": [{"id": book_1.pk, "sku_number": "Z"}, {"id": book_2.pk, "sku_number": book_1.sku_number}]},
+    )
+
+    serializer.is_valid(raise_exception=True)
+    serializer.save()
+    assert Book.objects.get(pk=book_1.pk).sku_number == "Z"
+    assert Book.objects.get(pk=book_2.pk).sku_number == book_1.sku_number
+
+
+@pytest.mark.parametrize("serializer_class", [AuthorSerializer, AuthorBulkSerializer])
+def test_unique_freed_by_previous_delete(author, books, serializer_class):
+    book = books.get(author=author)
+    serializer = serializer_class(
+        author,
+        partial=True,
+        data={"books": [{"id": book.pk, "_delete": True}, {"name": "n", "sku_number": book.sku_number}]},
+    )
+
+    serializer.is_valid(raise_exception=True)
+    serializer.save()
+    assert not Book.objects.filter(pk=book.pk).exists()
+    assert Book.objects.get(sku_number=book.sku_number).name == "n"
+
+
+def test_unique_freed_by_next_update(author, books):
+    book_1 = books.get(author=author)
+    book_2 = books.get(author=author)
+    serializer = AuthorSerializer(
+        author,
+        partial=True,
+        data={"books": [{"id": book_2.pk, "sku_number": book_1.sku_number}, {"id": book_1.pk, "sku_number": "Z"}]},
+    )
+
+    serializer.is_valid(raise_exception=True)
+    with pytest.raises(serializers.ValidationError) as err:
+        serializer.save()
+    assert err.value.detail == {"books": [{"sku_number": ["book with this sku number already exists."]}, {}]}
+
+
 # TODO: Fix this.
 @pytest.mark.skip("Unique together validation is not working.")
 def test_unique_together(author, user):
@@ -640,6 +752,178 @@ def test_deleting_on_create(author):
     assert err.value.detail == {"books": [{"_delete": ["You can't delete not exist object."]}]}
 
 
+def test_bulk_write(author, books, django_assert_max_num_queries):
+    book_1 = books.get(author=author)
+    book_2 = books.get(author=author)
+    book_3 = books.get(author=author)
+    book_qs = Book.objects.filter(author=author)
+    serializer = AuthorBulkSerializer(
+        author,
+        partial=True,
+        data={
+            "books": [
+                {"id": book_1.pk, "name": "Scary Tales 1"},
+                {"id": book_2.pk, "_delete": True},
+                {"name": "Scary Tales 4", "sku_number": "123"},
+                {"name": "Scary Tales 5", "sku_number": "456"},
+            ]
+        },
+    )
+
+    serializer.is_valid(raise_exception=True)
+    with django_assert_max_num_queries(13):
+        serializer.save()
+
+    assert set(book_qs.values_list("name", flat=True)) == {
+        "Scary Tales 1",
+        book_3.name,
+        "Scary Tales 4",
+        "Scary Tales 5",
+    }
+    assert Book.objects.get(pk=book_1.pk).sku_number == book_1.sku_number
+
+
+def test_bulk_write_no_returning_pks(author, books):
+    book = books.get(author=author)
+    serializer = AuthorBulkSerializer(
+        author,
+        partial=True,
+        data={
+            "books": [
+                {"id": book.pk, "name": "Scary Tales 1"},
+                {"name": "Scary Tales 2", "sku_number": "123"},
+            ]
+        },
+    )
+    serializer.is_valid(raise_exception=True)
+
+    features = type(connection.features)
+    bulk_save = WritableListSerializer._bulk_save
+    with patch.object(features, "can_return_rows_from_bulk_insert", False), patch.object(
+        WritableListSerializer, "_bulk_save", autospec=True, side_effect=bulk_save
+    ) as mock_bulk_save:
+        serializer.save()
+
+    created = mock_bulk_save.call_args[0][1]
+    assert len(created) == 1
+    assert Book.objects.get(pk=created[0][0].pk).name == "Scary Tales 2"
+
+
+def test_bulk_write_errors(author, book):
+    serializer = AuthorBulkSerializer(
+        author,
+        partial=True,
+        data={
+            "books": [
+                {"name": "Scary Tales 1"},
+                {"id": 404, "name": "Scary Tales 2"},
+                {"name": "Scary Tales 3", "sku_number": book.sku_number},
+            ]
+        },
+    )
+
+    serializer.is_valid(raise_exception=True)
+    with pytest.raises(serializers.ValidationError) as err:
+        serializer.save()
+
+    assert err.value.detail == {
+        "books": [
+            {"sku_number": ["This field is required."]},
+            {"id": ["Book with pk `404` doesn't exists."]},
+            {"sku_number": ["book with this sku number already exists."]},
+        ]
+    }
+    assert Book.objects.filter(author=author).count() == 1
+
+
+def test_load_payload_only(author, books):
+    book_1 = books.get(author=author)
+    book_2 = books.get(author=author)
+    serializer = AuthorLoadPayloadSerializer(
+        author, partial=True, data={"books": [{"id": book_1.pk, "name": "Scary Tales 1"}]}
+    )
+
+    serializer.is_valid(raise_exception=True)
+    with CaptureQueriesContext(connection) as ctx:
+        serializer.save()
+
+    loading = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith('SELECT "sample_book"."id"')]
+    assert len(loading) == 1
+    assert " IN ({})".format(book_1.pk) in loading[0]
+    assert Book.objects.get(pk=book_1.pk).name == "Scary Tales 1"
+    assert Book.objects.get(pk=book_2.pk).name == book_2.name
+
+
+def test_load_payload_only_deleting_excess(author, books):
+    book_1 = books.get(author=author)
+    books.get(author=author)
+    serializer = AuthorLoadPayloadSerializer(
+        author,
+        data={
+            "first_name": "Joe",
+            "last_name": "Soap",
+            "books": [
+                {"id": book_1.pk, "name": "Scary Tales 1", "sku_number": "123"},
+                {"name": "Scary Tales 3", "sku_number": "789"},
+            ],
+        },
+    )
+
+    serializer.is_valid(raise_exception=True)
+    serializer.save()
+
+    assert list(Book.objects.filter(author=author).values_list("name", flat=True)) == [
+        "Scary Tales 1",
+        "Scary Tales 3",
+    ]
+
+
+def test_load_payload_only_raw_delete(author, activities):
+    activity_1 = activities.get()
+    activity_2 = activities.get()
+    activities.get()
+    serializer = AuthorLoadPayloadSerializer(
+        author,
+        data={
+            "first_name": "Joe",
+            "last_name": "Soap",
+            "activities": [
+                {"id": activity_1.pk, "activity_type": "view", "activity_count": 1},
+                {"activity_type": "read", "activity_count": 2},
+            ],
+        },
+    )
+
+    serializer.is_valid(raise_exception=True)
+    with CaptureQueriesContext(connection) as ctx:
+        serializer.save()
+
+    queries = [q["sql"] for q in ctx.captured_queries if "sample_activity" in q["sql"]]
+    assert len([q for q in queries if q.startswith("DELETE")]) == 1
+    assert not [q for q in queries if q.startswith("SELECT") and " IN " not in q]
+    assert set(Activity.objects.filter(object_id=author.pk).values_list("activity_type", flat=True)) == {
+        "view",
+        "read",
+    }
+    assert not Activity.objects.filter(pk=activity_2.pk).exists()
+
+
+def test_load_payload_only_prefetched(author, books):
+    book_1 = books.get(author=author)
+    books.get(author=author)
+    author = Author.objects.prefetch_related("books").get(pk=author.pk)
+    serializer = AuthorLoadPayloadSerializer(
+        author, partial=True, data={"books": [{"id": book_1.pk, "name": "Scary Tales 1"}]}
+    )
+
+    serializer.is_valid(raise_exception=True)
+    with CaptureQueriesContext(connection) as ctx:
+        serializer.save()
+
+    assert not [q for q in ctx.captured_queries if q["sql"].startswith('SELECT "sample_book"."id"')]
+    assert Book.objects.get(pk=book_1.pk).name == "Scary Tales 1"
+
+
 # RecursiveListSerializer Tests
 
 
@@ -669,6 +953,21 @@ def test_id_field():
     assert serializer.pk_field == serializer.fields["id"]
 
 
+def test_pk_field_cached_per_class():
+    serializer = AuthorIDSerializer()
+    assert serializer.pk_field == serializer.fields["id"]
+    assert AuthorIDSerializer.__dict__["_model_pk_name"] == "id"
+
+    serializer = AuthorPKSerializer()
+    assert serializer.pk_field == serializer.fields["pk"]
+
+    # fields customized per instance
+    serializer = AuthorPKSerializer()
+    serializer.fields.pop("pk")
+    serializer.fields["id"] = serializers.IntegerField()
+    assert serializer.pk_field == serializer.fields["id"]
+
+
 def test_pk_abstract():
     serializer = CategoryAbstractPKSerializer()
     with pytest.raises(ValueError):
@@ -700,6 +999,19 @@ def test_writable_nested_validation_not_implemented(user):
         serializer.save()
 
 
+def test_writable_nested_relation_plan_cached():
+    serializer = AuthorSerializer()
+    plan = serializer._get_relation_plan(serializer.fields["profile_images"])
+    assert plan.relation_type == "forward"
+    assert plan.related_fields == (("object_id", "id"),)
+    assert plan.content_type_field_name == "content_type"
+    assert plan.extra_data == {"code": "author_profile_image"}
+
+    other = AuthorSerializer()
+    assert other._get_relation_plan(other.fields["profile_images"]) is plan
+    assert ReviewAuthorSerializer._relation_plans is not AuthorSerializer._relation_plans
+
+
 # UserContextSerializerMixin Tests
 
 
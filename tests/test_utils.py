@@ -1,3 +1,6 @@
+import pytest
+
+from tests.factories import AuthorFactory
 from unicef_restlib import utils
 
 
@@ -11,3 +14,99 @@ def test_get_attribute_smart_no_attrs():
 
 def test_get_attribute_smart():
     assert utils.get_attribute_smart({"instances": [{"id": 1}, {"id": 2}, {"id": 3}]}, "instances.id") == [1, 2, 3]
+
+
+def test_compile_path():
+    data = {"instances": [{"id": 1, "tags": [{"name": "a"}, {"name": "b"}]}, {"id": 2, "tags": [{"name": None}]}, None]}
+    get_ids = utils.compile_path("instances.id")
+    assert get_ids is utils.compile_path("instances.id")
+    assert get_ids(data) == [1, 2, None]
+    assert utils.compile_path(("instances", "tags", "name"))(data) == [["a", "b"], [None], None]
+    assert utils.compile_path("")(data) is data
+
+
+def test_compile_path_flat():
+    data = {"instances": [{"id": 1, "tags": [{"name": "a"}, {"name": "b"}]}, {"id": 2, "tags": []}, None]}
+    assert utils.compile_path("instances.id", flat=True)(data) == [1, 2]
+    assert utils.compile_path("instances.tags.name", flat=True)(data) == ["a", "b"]
+    assert utils.compile_path("instances.tags.name", flat=True)(None) == []
+
+
+@pytest.mark.django_db
+def test_get_attribute_smart_related(author, reviews):
+    reviews.get(author=author, rating=1)
+    reviews.get(author=author, rating=2)
+    assert sorted(utils.get_attribute_smart([author], ["reviews", "rating"])) == [1, 2]
+    assert sorted(utils.compile_path("reviews.rating", flat=True)(author)) == [1, 2]
+
+
+def test_get_values_lookup():
+    from demo.sample.models import Author, Book, Image
+
+    assert utils.get_values_lookup(Book, ("author", "first_name")) == "author__first_name"
+    assert utils.get_values_lookup(Book, ("isbn", "code")) == "isbn__code"
+    assert utils.get_values_lookup(Book, ("name",)) == "name"
+    assert utils.get_values_lookup(Book, ("author",)) is None
+    assert utils.get_values_lookup(Book, ("author", "missed")) is None
+    assert utils.get_values_lookup(Author, ("reviews", "rating")) is None
+    assert utils.get_values_lookup(Image, ("obj", "first_name")) is None
+
+
+@pytest.mark.django_db
+def test_get_attribute_smart_pushdown(author, books, isbn, django_assert_num_queries):
+    book = isbn.book
+    other_book = books.get()
+
+    with django_assert_num_queries(1):
+        assert set(utils.get_attribute_smart(author, "books.isbn.code")) == {None, isbn.code}
+    with django_assert_num_queries(1):
+        assert utils.get_attribute_smart(author.books.order_by("pk"), "author.first_name") == [author.first_name] * 2
+    with django_assert_num_queries(1):
+        assert sorted(utils.compile_path("books.name", flat=True)(author)) == sorted([book.name, other_book.name])
+
+    # objects are loaded if path can't be expressed as lookup
+    assert utils.get_attribute_smart(author.books.order_by("pk"), "author.__str__") == [str(author)] * 2
+
+    # prefetched objects are reused
+    author = author._meta.model.objects.prefetch_related("books").get(pk=author.pk)
+    with django_assert_num_queries(0):
+        assert sorted(utils.get_attribute_smart(author, "books.name")) == sorted([book.name, other_book.name])
+
+
+def test_iterate_attribute_smart():
+    data = {"instances": [{"id": 1, "tags": [{"name": "a"}, {"name": "b"}]}, {"id": 2, "tags": [{"name": None}]}]}
+    values = utils.iterate_attribute_smart(data, "instances.tags.name")
+    assert not isinstance(values, list)
+    assert list(values) == ["a", "b"]
+    assert list(utils.iterate_attribute_smart(data, ["instances", "id"])) == [1, 2]
+    assert list(utils.iterate_attribute_smart(None, "instances.id")) == []
+
+
+@pytest.mark.django_db
+def test_iterate_attribute_smart_queryset(author, books, isbn, reviews, django_assert_num_queries):
+    other_book = books.get()
+    reviews.get(author=author, rating=1)
+    reviews.get(author=author, rating=2)
+
+    with django_assert_num_queries(1):
+        assert list(utils.iterate_attribute_smart(author, "books.isbn.code")) == [isbn.code]
+    usernames = sorted(review.user.username for review in author.reviews.all())
+    with django_assert_num_queries(1):
+        assert sorted(utils.iterate_attribute_smart(author, "reviews.user.username")) == usernames
+    with django_assert_num_queries(1):
+        assert sorted(book.pk for book in utils.iterate_attribute_smart(author, "books")) == sorted(
+            [isbn.book.pk, other_book.pk]
+        )
+
+
+@pytest.mark.django_db
+def test_get_attribute_smart_pushdown_distinct(books):
+    from demo.sample.models import Author
+
+    for __ in range(2):
+        books.get(author=AuthorFactory(first_name="Joe"))
+    queryset = Author.objects.filter(books__isnull=False, first_name="Joe").distinct()
+
+    assert utils.get_attribute_smart(queryset, "first_name") == ["Joe", "Joe"]
+    assert list(utils.iterate_attribute_smart(queryset, "first_name")) == ["Joe", "Joe"]
+    assert utils.compile_path("first_name", flat=True)(queryset) == ["Joe", "Joe"]
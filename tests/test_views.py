@@ -1,10 +1,29 @@
-from django.db import ProgrammingError
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, ProgrammingError
+from django.db.models import Prefetch
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
+from rest_framework import viewsets
+from rest_framework.generics import ListAPIView
+from rest_framework.request import Request
+
 import pytest
+from unittest.mock import patch
+
+from tests.factories import AuthorFactory, BookFactory, ISBNFactory, ReviewFactory
+from unicef_restlib.views import (
+    ExportPrefetchMixin,
+    merge_prefetch_lookups,
+    MultiSerializerViewSetMixin,
+    NestedViewSetMixin,
+    warm_up_serializer,
+)
 
-from demo.sample.models import Book
+from demo.sample import serializers
+from demo.sample.models import Author, Book, ISBN
 from demo.sample.utils import author_description
+from demo.sample.views import AuthorBookNestedViewSet, AuthorView, AuthorViewSet, BookISBNNestedViewSet
 
 pytestmark = pytest.mark.django_db
 
@@ -193,6 +212,8 @@ def test_nested_view_get_root_object_no_parent(client, author):
         ("?first_name=test,demo", 2),
         ("?name=test", 2),
         ("?custom=best", 2),
+        ("?custom=best,unknown", 2),
+        ("?first_name_exists=true&active=false", 1),
     ],
 )
 def test_query_string_api_view(api_client, superuser, query_string, results_len, authors):
@@ -208,7 +229,230 @@ def test_query_string_api_view(api_client, superuser, query_string, results_len,
     assert len(results) == results_len
 
 
+def test_query_string_filters_plan_cached():
+    plan = AuthorView.get_filters_plan(AuthorView.filters)
+    assert AuthorView.get_filters_plan(AuthorView.filters) is plan
+    assert set(plan.keys()) == {"first_name", "active", "name", "custom", "first_name_exists"}
+
+    custom_filters = (("last_name", "last_name__in"),)
+    assert set(AuthorView.get_filters_plan(custom_filters).keys()) == {"last_name"}
+
+
 def test_nested_url(client, author, book):
     url = "{}{}/books/".format(reverse("sample:author-list"), author.pk)
     response = client.get(url)
     assert response.status_code == 200
+
+
+def test_nested_view_parent_object_cached(rf, author, book, django_assert_num_queries):
+    request = Request(rf.get("/"))
+    kwargs = {"author_pk": author.pk, "book_pk": book.pk}
+    view = BookISBNNestedViewSet(request=request, kwargs=kwargs, format_kwarg=None, action="create")
+
+    # parent chain is fetched with single query
+    with django_assert_num_queries(1):
+        assert view.get_parent_object() == book
+        assert view.get_parent_object() == book
+        assert view.get_root_object() == author
+
+    parent_view = AuthorBookNestedViewSet(request=request, kwargs=kwargs, format_kwarg=None, action="create")
+    with django_assert_num_queries(0):
+        assert parent_view.get_parent_object() == author
+
+
+def test_nested_view_parent_object_chain(client, author, book):
+    url = reverse("sample:book-isbns-list", args=[author.pk, book.pk])
+    response = client.post(url, data={"code": "54321"})
+    assert response.status_code == 201
+    assert ISBN.objects.filter(book=book, code="54321").exists()
+
+    other_author = AuthorFactory()
+    url = reverse("sample:book-isbns-list", args=[other_author.pk, book.pk])
+    response = client.post(url, data={"code": "12345"})
+    assert response.status_code == 404
+
+
+def test_nested_view_parent_exists_filter(client, author, book, isbn, django_assert_num_queries):
+    url = reverse("sample:book-isbns-list", args=[author.pk, book.pk])
+    with django_assert_num_queries(1):
+        response = client.get(url)
+    assert response.status_code == 200
+    assert [item["code"] for item in response.json()] == [isbn.code]
+
+    # parent is not available in parent viewset queryset
+    author.active = False
+    author.save()
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def test_nested_view_parent_filter_templates(rf, author, book):
+    assert BookISBNNestedViewSet._get_parents() == (AuthorBookNestedViewSet, AuthorViewSet)
+    assert BookISBNNestedViewSet._get_parent_filter_templates() == (
+        ("book__pk", "book_pk"),
+        ("book__author__pk", "author_pk"),
+    )
+    # templates are computed once per class
+    assert BookISBNNestedViewSet._get_parent_filter_templates() is BookISBNNestedViewSet._get_parent_filter_templates()
+
+    request = Request(rf.get("/"))
+    kwargs = {"author_pk": author.pk, "book_pk": book.pk}
+    view = BookISBNNestedViewSet(request=request, kwargs=kwargs, format_kwarg=None, action="list")
+    assert view._get_parent_filters() == {"book__pk": book.pk, "book__author__pk": author.pk}
+
+
+def test_nested_view_parent_request(rf, author, book):
+    request = Request(rf.get("/", {"code": "12345"}))
+    query_params = request.query_params
+    kwargs = {"author_pk": author.pk, "book_pk": book.pk}
+    view = BookISBNNestedViewSet(request=request, kwargs=kwargs, format_kwarg=None, action="list")
+
+    parent = view.get_parent()
+    assert not parent.request.query_params
+    assert not parent.request.GET
+    assert parent.request.method == "GET"
+    assert parent._get_parent_objects_cache() is view._get_parent_objects_cache()
+
+    assert view.get_parent_object() == book
+    assert view.get_root_object() == author
+    # original request is not changed
+    assert request.query_params is query_params
+    assert request._request.GET["code"] == "12345"
+
+
+def test_multi_serializer_view_warm_up():
+    class AuthorMultiSerializerViewSet(MultiSerializerViewSetMixin, viewsets.ModelViewSet):
+        queryset = AuthorViewSet.queryset
+        serializer_class = serializers.AuthorSerializer
+        serializer_action_classes = {"list": serializers.AuthorMetaSerializer, "metadata": serializers.AuthorSerializer}
+        warm_up_serializers = True
+
+    with patch("unicef_restlib.views.warm_up_serializer") as warm_up:
+        AuthorMultiSerializerViewSet.as_view({"get": "list"})
+        AuthorMultiSerializerViewSet.as_view({"get": "retrieve"})
+    # serializers are warmed up once per view class
+    assert sorted(type(call.args[0]).__name__ for call in warm_up.call_args_list) == [
+        "AuthorMetaSerializer",
+        "AuthorSerializer",
+    ]
+
+
+def test_multi_serializer_view_unknown_action():
+    class AuthorMultiSerializerViewSet(MultiSerializerViewSetMixin, viewsets.ReadOnlyModelViewSet):
+        queryset = AuthorViewSet.queryset
+        serializer_class = serializers.AuthorSerializer
+        serializer_action_classes = {"create": serializers.AuthorMetaSerializer}
+
+    with pytest.raises(ImproperlyConfigured):
+        AuthorMultiSerializerViewSet.as_view({"get": "list"})
+
+
+def test_multi_serializer_view_not_serializer():
+    class AuthorMultiSerializerViewSet(MultiSerializerViewSetMixin, viewsets.ModelViewSet):
+        queryset = AuthorViewSet.queryset
+        serializer_class = serializers.AuthorSerializer
+        serializer_action_classes = {"list": serializers.AuthorMetaSerializer()}
+
+    with pytest.raises(ImproperlyConfigured):
+        AuthorMultiSerializerViewSet.as_view({"get": "list"})
+
+
+def test_warm_up_serializer():
+    serializer = serializers.AuthorSerializer(context={})
+    warm_up_serializer(serializer)
+    assert "fields" in serializer.fields["books"].child.__dict__
+
+
+def test_export_prefetch(client, django_assert_num_queries):
+    for author in AuthorFactory.create_batch(5):
+        for rating in [1, 2]:
+            ReviewFactory(author=author, rating=rating)
+            ISBNFactory(
+                book=BookFactory(author=author, name="Book {}".format(rating)), code="{}{}".format(author.pk, rating)
+            )
+
+    # authors, reviews, books and isbns
+    with django_assert_num_queries(4):
+        response = client.get(reverse("sample:authors-export"))
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data) == 5
+    assert sorted(data[0]["review_ratings"].split(", ")) == ["1", "2"]
+    assert sorted(data[0]["book_names"].split(", ")) == ["Book 1", "Book 2"]
+    assert sorted(data[0]["book_isbns"].split(", ")) == ["{}1".format(data[0]["id"]), "{}2".format(data[0]["id"])]
+
+
+def test_merge_prefetch_lookups():
+    books = Prefetch("books", queryset=Book.objects.only("pk", "name", "author"))
+    reviews = Prefetch("reviews")
+    assert merge_prefetch_lookups([], [books, reviews]) == [books, reviews]
+    # relation is traversed by other lookup, so it is prefetched without queryset
+    assert merge_prefetch_lookups([], ["books__isbn", books]) == ["books", "books__isbn"]
+    assert merge_prefetch_lookups(["books__isbn"], [books, reviews]) == ["books", reviews]
+    assert merge_prefetch_lookups(["reviews"], [reviews]) == []
+
+
+def test_export_batch(client, django_assert_num_queries):
+    for author in AuthorFactory.create_batch(5):
+        for rating in [2, 1, 1]:
+            ReviewFactory(author=author, rating=rating)
+        for i in [1, 2]:
+            ISBNFactory(book=BookFactory(author=author, name="Book {}".format(i)), code="{}{}".format(author.pk, i))
+        BookFactory(author=author, name="Book 3")
+
+    # authors, reviews, books and isbns
+    with django_assert_num_queries(4):
+        response = client.get(reverse("sample:authors-export-batch"))
+    assert response.status_code == 200
+    data = response.json()
+    assert data[0]["review_ratings"] == "2, 1, 1"
+    assert data[0]["book_names"] == "Book 1, Book 2, Book 3"
+    assert data[0]["book_isbns"] == "{0}1, {0}2".format(data[0]["id"])
+
+    # representation is the same as for single object
+    assert client.get(reverse("sample:authors-export")).json() == data
+
+
+def test_export_prefetch_relation_read_by_other_field(rf):
+    class AuthorExportPrefetchView(ExportPrefetchMixin, ListAPIView):
+        queryset = Author.objects.order_by("pk")
+        serializer_class = serializers.AuthorSerializer
+
+    for author in AuthorFactory.create_batch(3):
+        for rating in [1, 2]:
+            ReviewFactory(author=author, rating=rating)
+
+    view = AuthorExportPrefetchView(request=Request(rf.get("/")), format_kwarg=None)
+    # nested reviews serializer needs all fields of reviews
+    assert view.get_export_prefetch_lookups() == ["reviews"]
+
+    with CaptureQueriesContext(connection) as prefetched:
+        data = serializers.AuthorSerializer(view.get_queryset(), many=True).data
+    with CaptureQueriesContext(connection) as not_prefetched:
+        assert serializers.AuthorSerializer(Author.objects.order_by("pk"), many=True).data == data
+    assert len(prefetched) < len(not_prefetched)
+
+
+def test_export_prefetch_parent_viewset(rf, author, book, django_assert_num_queries):
+    class AuthorExportViewSet(ExportPrefetchMixin, viewsets.ModelViewSet):
+        queryset = Author.objects.all()
+        serializer_class = serializers.AuthorExportSerializer
+
+    class BookExportNestedViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
+        parent = AuthorExportViewSet
+        parent_lookup_field = "author"
+        parent_lookup_kwarg = "author_pk"
+        queryset = Book.objects.all()
+        serializer_class = serializers.BookSerializer
+
+    request = Request(rf.get("/"))
+    view = BookExportNestedViewSet(request=request, kwargs={"author_pk": author.pk}, format_kwarg=None, action="list")
+    # parent is fetched without export prefetches
+    with django_assert_num_queries(1):
+        assert view.get_parent_object() == author
+
+    view = AuthorExportViewSet(request=request, kwargs={}, format_kwarg=None, action="retrieve")
+    assert not view.get_queryset()._prefetch_related_lookups
+    view = AuthorExportViewSet(request=request, kwargs={}, format_kwarg=None, action="list")
+    assert view.get_queryset()._prefetch_related_lookups